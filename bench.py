@@ -0,0 +1,269 @@
+#!/usr/bin/env python3.7
+
+"""Benchmarks for the book pipeline.
+
+Runs against the bundled book source, with SnuggleTeX replaced by a fast,
+deterministic fake so no JVM is needed; the numbers measure our own code,
+not the converter's. Everything happens in a scratch directory.
+
+    ./bench.py --save baseline.json
+    ./bench.py --compare baseline.json
+"""
+
+import argparse
+import contextlib
+import glob
+import html
+import io
+import json
+import os
+from os import path
+import platform
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+from typing import Callable, Dict
+
+from termcolor import colored, cprint
+
+import cache
+import converter
+import delete_unused_images
+import epub
+import process_book_html
+
+BOOK_ARCHIVE = 'information-retrieval.tar.gz'
+SAMPLE_CHAPTERS = [
+    'bibliography-1.html',
+    'index-1.html',
+    'latent-semantic-indexing-1.html',
+    'k-means-1.html',
+]
+
+
+def fake_run(tex: str) -> subprocess.CompletedProcess:
+    """Stands in for `converter.run`, without starting a JVM."""
+    return subprocess.CompletedProcess(
+        args=converter.ONESHOT_COMMAND,
+        returncode=0,
+        stdout='<math xmlns="http://www.w3.org/1998/Math/MathML"><mi>'
+        + html.escape(tex) + '</mi></math>',
+        stderr='',
+    )
+
+
+def best_of(repeat: int, fn: Callable[[], None],
+            setup: Callable[[], None] = lambda: None) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        setup()
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def clear_cache():
+    for fname in glob.glob(cache.CACHE_DB + '*'):
+        os.remove(fname)
+    shutil.rmtree(cache.CACHE_DIR, ignore_errors=True)
+
+
+def copy_assets():
+    """Put the images next to the pages, which `epub.py` expects."""
+    for fname in os.listdir(process_book_html.BOOK_SRC_DIR):
+        if fname.endswith(('.png', '.jpg')):
+            shutil.copy(path.join(process_book_html.BOOK_SRC_DIR, fname),
+                        process_book_html.OUTPUT_DIR)
+
+
+def build_book(jobs: int):
+    with contextlib.redirect_stdout(io.StringIO()):
+        process_book_html.main(['--force', '--jobs', str(jobs)])
+    copy_assets()
+    book = epub.make_epub()
+    epub.write_book(book)
+
+
+def bench_pipeline(results: Dict[str, float], repeat: int, jobs: int):
+    results['pipeline (cold cache)'] = best_of(repeat, lambda: build_book(jobs),
+                                               setup=clear_cache)
+    results['pipeline (warm cache)'] = best_of(repeat, lambda: build_book(jobs))
+
+    book = epub.make_epub()
+    results['epub.make_epub'] = best_of(repeat, epub.make_epub)
+    results['epub.write_book'] = best_of(repeat, lambda: epub.write_book(book))
+    streaming_book = epub.make_epub(streaming=True)
+    results['epub.write_book (streaming)'] = best_of(
+        repeat, lambda: epub.write_book(streaming_book)
+    )
+
+
+def bench_chapters(results: Dict[str, float], repeat: int):
+    cache.init_cache()
+    for name in SAMPLE_CHAPTERS:
+        chapter = process_book_html.read(path.join(process_book_html.BOOK_SRC_DIR, name))
+        results[f'process_chapter {name}'] = best_of(
+            repeat, lambda: process_book_html.process_chapter(chapter)
+        )
+
+    formulas = []
+    for name in SAMPLE_CHAPTERS:
+        formulas.extend(process_book_html.chapter_formulas(
+            path.join(process_book_html.BOOK_SRC_DIR, name)
+        ))
+
+    def convert_all():
+        for tex in formulas:
+            process_book_html.tex_to_mathml(tex)
+    results[f'tex_to_mathml x{len(formulas)} (warm)'] = best_of(repeat, convert_all)
+
+
+def bench_cache_backends(results: Dict[str, float], repeat: int, entries: int = 5000):
+    data = [(cache.stable_hash(str(i)), fake_run(f'$x_{{{i}}}$').stdout)
+            for i in range(entries)]
+    for name, backend_class in sorted(cache.BACKENDS.items()):
+        backend = None
+
+        def fresh():
+            nonlocal backend
+            clear_cache()
+            backend = backend_class()
+            backend.init()
+
+        def write_all():
+            for digest, value in data:
+                backend.write(digest, value)
+
+        def read_all():
+            for digest, _ in data:
+                backend.read(digest)
+
+        results[f'cache {name} write x{entries}'] = best_of(repeat, write_all, setup=fresh)
+        results[f'cache {name} read x{entries}'] = best_of(repeat, read_all)
+
+    values = [value for _, value in data]
+    compressed = [cache.compress(value) for value in values]
+    results[f'cache compress x{entries}'] = best_of(
+        repeat, lambda: [cache.compress(value) for value in values]
+    )
+    results[f'cache decompress x{entries}'] = best_of(
+        repeat, lambda: [cache.decompress(value) for value in compressed]
+    )
+
+    memo = cache.Memo(entries)
+    for digest, value in data:
+        memo.put(digest, value)
+    results[f'cache memo read x{entries}'] = best_of(
+        repeat, lambda: [memo.get(digest) for digest, _ in data]
+    )
+    clear_cache()
+
+
+def bench_delete_unused_images(results: Dict[str, float], repeat: int):
+    scratch = 'delete-unused-images'
+    real_output_dir = process_book_html.OUTPUT_DIR
+
+    def setup():
+        shutil.rmtree(scratch, ignore_errors=True)
+        shutil.copytree(real_output_dir, scratch)
+
+    process_book_html.OUTPUT_DIR = scratch
+    try:
+        results['delete_unused_images'] = best_of(
+            repeat, lambda: delete_unused_images.main([]), setup=setup
+        )
+    finally:
+        process_book_html.OUTPUT_DIR = real_output_dir
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+def compare(results: Dict[str, float], baseline: Dict[str, float],
+            threshold: float) -> bool:
+    """Print both runs side by side; returns whether anything regressed."""
+    regressed = False
+    width = max(map(len, results))
+    for name, seconds in results.items():
+        line = f'{name:<{width}}  {seconds:9.4f}s'
+        if name in baseline:
+            change = seconds / baseline[name] - 1 if baseline[name] else 0.0
+            color = None
+            if change > threshold:
+                color = 'red'
+                regressed = True
+            elif change < -threshold:
+                color = 'green'
+            line += '  ' + colored(
+                f'{baseline[name]:9.4f}s  {change:+7.1%}', color
+            )
+        print(line)
+    return regressed
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='runs per benchmark; the fastest is reported (default: 3)')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='--jobs for the full pipeline (default: 1)')
+    parser.add_argument('--only', choices=['pipeline', 'chapters', 'cache', 'images'],
+                        action='append', help='run only these benchmarks')
+    parser.add_argument('--save', metavar='FILE', help='write results as a baseline')
+    parser.add_argument('--compare', metavar='FILE', help='compare against a baseline')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='slowdown that counts as a regression (default: 0.1)')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    only = set(args.only or ['pipeline', 'chapters', 'cache', 'images'])
+    archive = path.realpath(BOOK_ARCHIVE)
+    css = path.realpath(epub.css_filename)
+    save = args.save and path.realpath(args.save)
+    baseline_fname = args.compare and path.realpath(args.compare)
+
+    converter.run = fake_run
+    results: Dict[str, float] = {}
+    with tempfile.TemporaryDirectory(prefix='process-book-html-bench.') as workdir:
+        os.chdir(workdir)
+        with tarfile.open(archive, 'r:*') as tar:
+            tar.extractall()
+        shutil.copy(css, epub.css_filename)
+
+        if only & {'pipeline', 'images'}:
+            bench_pipeline(results, args.repeat, args.jobs)
+        if 'chapters' in only:
+            bench_chapters(results, args.repeat)
+        if 'cache' in only:
+            bench_cache_backends(results, args.repeat)
+        if 'images' in only:
+            bench_delete_unused_images(results, args.repeat)
+        os.chdir('/')
+
+    baseline = {}
+    if baseline_fname:
+        with open(baseline_fname) as f:
+            baseline = json.load(f)['results']
+    regressed = compare(results, baseline, args.threshold)
+
+    if save:
+        with open(save, 'w') as f:
+            json.dump({
+                'python': platform.python_version(),
+                'machine': platform.machine(),
+                'results': results,
+            }, f, indent=2)
+        cprint(f'Saved results to {args.save}', 'green', attrs=['bold'])
+
+    if regressed:
+        cprint('Some benchmarks regressed', 'red', attrs=['bold'])
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""Per-book settings, loaded from a JSON manifest in `books/`.
+
+`process_book_html` and `epub` keep their settings in module constants,
+which default to Introduction to Information Retrieval. A `Book` holds a
+full set of them, and `activate` installs it in both modules; `build.py`
+activates each book before working on it, in each process.
+"""
+
+import json
+from dataclasses import MISSING, dataclass, fields
+from os import path
+from typing import Optional
+
+import epub
+import process_book_html
+
+
+@dataclass
+class Book:
+    # LaTeX2HTML output, and where the cleaned-up pages go
+    src_dir: str
+    output_dir: str
+    online_src_base: str
+    # Present only in the title page's source, which keeps its child links
+    index_marker: str
+    # LaTeX2HTML's stylesheet link, which we drop
+    stylesheet_url: str
+
+    # EPUB metadata and assembly
+    uuid: str
+    isbn: str
+    language: str
+    title: str
+    author: str
+    published: str
+    publisher: str
+    cover: str
+    contents: str
+    index: str
+    css: str
+    epub: str
+
+    # A TeX file of `\newcommand`s for the macros the book's formulas use;
+    # without one, those in `process_book_html.NEWCOMMANDS`
+    macros: Optional[str] = None
+
+    @classmethod
+    def load(cls, fname: str) -> 'Book':
+        with open(fname, encoding='utf-8') as f:
+            settings = json.load(f)
+        names = {field.name for field in fields(cls)}
+        unknown = settings.keys() - names
+        if unknown:
+            raise ValueError(f'{fname}: unknown settings: {", ".join(sorted(unknown))}')
+        required = {field.name for field in fields(cls) if field.default is MISSING}
+        missing = required - settings.keys()
+        if missing:
+            raise ValueError(f'{fname}: missing settings: {", ".join(sorted(missing))}')
+        return cls(**settings)
+
+    @property
+    def name(self) -> str:
+        return path.splitext(path.basename(self.epub))[0]
+
+    def activate(self):
+        process_book_html.BOOK_SRC_DIR = self.src_dir
+        process_book_html.OUTPUT_DIR = self.output_dir
+        process_book_html.MANIFEST_FILENAME = path.join(self.output_dir, '.manifest.json')
+        process_book_html.ONLINE_SRC_BASE = self.online_src_base
+        process_book_html.IRBOOK_MARKER = self.index_marker
+        process_book_html.IRBOOK_CSS = self.stylesheet_url
+        process_book_html.MACROS = process_book_html.load_macros(self.macros)
+
+        epub.book_uuid = self.uuid
+        epub.isbn = self.isbn
+        epub.language = self.language
+        epub.title = self.title
+        epub.author = self.author
+        epub.published = self.published
+        epub.publisher = self.publisher
+        epub.cover_fname = self.cover
+        epub.contents_fname = self.contents
+        epub.index_fname = self.index
+        epub.css_filename = self.css
+        epub.output_filename = self.epub
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3.7
+
+"""Build any number of books in one go.
+
+Each book is described by a JSON manifest; see `book.py` and `books/`.
+All of them share one formula cache, one pool of resident converters and
+one pool of worker processes. Formulas are de-duplicated and rendered
+across every book up front, then the stale chapters of all the books are
+queued on the same workers, so no core sits idle waiting for one book to
+finish before the next starts.
+
+    ./build.py books/*.json
+"""
+
+import argparse
+import multiprocessing
+from os import path
+import sys
+from typing import List, Optional
+
+from termcolor import cprint
+
+from book import Book
+import epub
+import process_book_html
+
+
+def copy_assets(book: Book):
+    """Put the book's images next to its pages, where `epub.py` expects them."""
+    for fname in process_book_html.source_files(process_book_html.ASSET_EXTENSIONS):
+        dest = path.join(book.output_dir, path.basename(fname))
+        data = process_book_html.read_source(fname)
+        if path.exists(dest) and path.getsize(dest) == len(data):
+            with open(dest, 'rb') as f:
+                if f.read() == data:
+                    continue
+        with open(dest, 'wb') as f:
+            f.write(data)
+
+
+def assemble_epub(book: Book) -> bool:
+    book.activate()
+    copy_assets(book)
+    epub_book = epub.make_epub(streaming=True)
+    if epub.check_book(epub_book):
+        return False
+    epub.write_book(epub_book)
+    return True
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument('books', metavar='BOOK', nargs='+',
+                        help='JSON manifest describing a book')
+    parser.add_argument('--no-epub', dest='epub', action='store_false',
+                        help="process the pages, but don't assemble the EPUBs")
+    process_book_html.add_build_arguments(parser)
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None):
+    args = parse_args(argv)
+    books = [Book.load(fname) for fname in args.books]
+    output_dirs = [book.output_dir for book in books]
+    if len(set(output_dirs)) != len(output_dirs):
+        cprint('Every book needs its own output_dir', 'red', attrs=['bold'])
+        sys.exit(1)
+    process_book_html.configure_build(args)
+
+    result = process_book_html.build(
+        [process_book_html.Target(book.name, book.activate) for book in books],
+        args,
+    )
+    if args.epub:
+        pool = None
+        if args.jobs > 1 and len(books) > 1:
+            pool = multiprocessing.Pool(min(args.jobs, len(books)))
+        try:
+            assemble = pool.imap if pool is not None else map
+            failed = False
+            for book, ok in zip(books, assemble(assemble_epub, books)):
+                if ok:
+                    cprint(f'Wrote {book.epub}', 'green')
+                else:
+                    cprint(f'Failed to assemble {book.epub}', 'red', attrs=['bold'])
+                    failed = True
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+        if failed:
+            sys.exit(1)
+
+    process_book_html.finish_build(args, result)
+    if result.failures:
+        sys.exit(1)
+    cprint('Done!', 'green', attrs=['bold'])
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,462 @@
+#!/usr/bin/env python3.7
+
 import os
 from os import path
+import atexit
 import hashlib
+import sqlite3
+import threading
+import time
+import argparse
+import zlib
+from collections import Counter, OrderedDict
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+import profiling
 
 CACHE_DIR = '.cache'
+CACHE_DB = '.cache.sqlite3'
+MEMO_SIZE = 8192
+
+# Entries are stored compressed, which for MathML mostly means referring
+# back to this: each entry alone is too short for zlib to find much to
+# reuse. The most common fragments go last, nearest the data. Entries
+# compressed with it can't be read without it, so any change to it needs a
+# new `COMPRESSED` marker rather than an edit.
+ZDICT = (
+    '<mtable><mtr><mtd></mtd></mtr></mtable>'
+    '<mstyle displaystyle="true"></mstyle>'
+    '<munderover></munderover><munder></munder><mover></mover>'
+    '<msqrt></msqrt><mfrac></mfrac><mtext></mtext>'
+    '<mi mathvariant="normal">log</mi><mo>∑</mo><mo>∈</mo>'
+    '<mo>≤</mo><mo>≥</mo><mo>×</mo><mo>⋅</mo>'
+    '<mo stretchy="false">(</mo><mo stretchy="false">)</mo>'
+    '<mo>(</mo><mo>)</mo><mo>-</mo><mo>+</mo><mo>,</mo><mo>=</mo>'
+    '<mspace width="0.5em"/><mn>1</mn><mn>0</mn>'
+    '<msubsup></msubsup><msup></msup></mi><mi>d</mi><mi>t</mi>'
+    '<mi>q</mi><mi>i</mi></mi></msub></mrow></mrow></math><mrow><msub><mi>'
+    '<math xmlns="http://www.w3.org/1998/Math/MathML">'
+).encode('utf-8')
+# Prefixes every compressed entry. Entries written before compression are
+# plain MathML, which never starts with a NUL.
+COMPRESSED = b'\0z1'
+
+# A stored entry: compressed bytes, or text from before compression
+Value = Union[str, bytes]
+
+
+def compress(data: str) -> bytes:
+    compressor = zlib.compressobj(9, zlib.DEFLATED, -15, zdict=ZDICT)
+    return COMPRESSED + compressor.compress(data.encode('utf-8')) + compressor.flush()
+
+
+def decompress(value: Value) -> str:
+    if isinstance(value, str):
+        return value
+    if not value.startswith(COMPRESSED):
+        return value.decode('utf-8')
+    decompressor = zlib.decompressobj(-15, zdict=ZDICT)
+    data = decompressor.decompress(value[len(COMPRESSED):]) + decompressor.flush()
+    return data.decode('utf-8')
+
+
+def is_compressed(value: Value) -> bool:
+    return isinstance(value, bytes) and value.startswith(COMPRESSED)
+
+
+def parse_size(s: str) -> int:
+    """A size in bytes, like `500000`, `640K`, `20M` or `1G`."""
+    units = {'K': 2**10, 'M': 2**20, 'G': 2**30}
+    s = s.strip().upper().rstrip('B')
+    try:
+        if s and s[-1] in units:
+            return int(float(s[:-1]) * units[s[-1]])
+        return int(s)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'not a size: {s!r}')
+
+
+@dataclass
+class Usage:
+    """How big an entry is, and how much it's been used."""
+    digest: str
+    size: int
+    # Unix time of the last write or use
+    last_used: float
+    # How many times it's been written or read from the backend (so not
+    # counting memo hits), or None if the backend doesn't count
+    uses: Optional[int]
+
+
+class DirectoryBackend:
+    """One file per entry, named by its key's hash, in a flat directory.
+
+    An entry's mtime is when it was last used, which is all `gc` has to go
+    on here: this backend doesn't count uses.
+    """
+
+    def __init__(self, cache_dir: str = CACHE_DIR):
+        self.cache_dir = cache_dir
+
+    def init(self):
+        if not path.exists(self.cache_dir):
+            os.mkdir(self.cache_dir)
+
+    def fname(self, digest: str) -> str:
+        return path.join(self.cache_dir, digest)
+
+    def read(self, digest: str) -> Optional[Value]:
+        try:
+            with open(self.fname(digest), 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        self.record_use(digest)
+        return data
+
+    def record_use(self, digest: str):
+        try:
+            os.utime(self.fname(digest))
+        except FileNotFoundError:
+            pass
+
+    def write(self, digest: str, data: Value):
+        # Parallel builds may read an entry while another worker writes it
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        dest = self.fname(digest)
+        tmp = f'{dest}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, dest)
+
+    def rewrite(self, entries: Iterable[Tuple[str, Value]]):
+        """Replace existing entries' values without counting it as a use."""
+        for digest, data in entries:
+            st = os.stat(self.fname(digest))
+            self.write(digest, data)
+            os.utime(self.fname(digest), ns=(st.st_atime_ns, st.st_mtime_ns))
+
+    def items(self) -> Iterator[Tuple[str, Value]]:
+        for digest in self.digests():
+            try:
+                with open(self.fname(digest), 'rb') as f:
+                    yield digest, f.read()
+            except FileNotFoundError:
+                pass
+
+    def digests(self) -> Iterator[str]:
+        return (digest for digest in os.listdir(self.cache_dir)
+                if not digest.endswith('.tmp'))
+
+    def usage(self) -> Iterator[Usage]:
+        for digest in self.digests():
+            try:
+                st = os.stat(self.fname(digest))
+            except FileNotFoundError:
+                continue
+            yield Usage(digest, st.st_size, st.st_mtime, None)
+
+    def delete_many(self, digests: Iterable[str]):
+        for digest in digests:
+            try:
+                os.remove(self.fname(digest))
+            except FileNotFoundError:
+                pass
+
+    def flush(self):
+        pass
+
+    def compact(self):
+        pass
+
+
+class SQLiteBackend:
+    """Every entry in one SQLite database.
+
+    WAL mode lets readers run alongside a writer, so parallel workers can
+    share one file. Connections can't cross threads or forks, so each thread
+    of each process opens its own.
+
+    Each entry records when it was last used and how many times it's been
+    read or written, for `gc`; reads the memo answers don't reach us, so
+    don't count. Uses are counted in memory and written in batches, since a
+    write per read would serialize parallel workers on the database's lock.
+    Call `flush` before a process goes away: a worker that's killed loses
+    whatever it hasn't written.
+    """
+
+    # Pending uses are written once there are this many
+    USE_BATCH = 512
+
+    def __init__(self, db_path: str = CACHE_DB):
+        self.db_path = db_path
+        self.local = threading.local()
+        self.uses_lock = threading.Lock()
+        self.uses: Counter = Counter()
+        self.uses_pid = os.getpid()
+
+    def connection(self) -> sqlite3.Connection:
+        if getattr(self.local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(self.db_path, timeout=60, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return self.local.conn
+
+    def init(self):
+        conn = self.connection()
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS entries ('
+            'key TEXT PRIMARY KEY, value TEXT NOT NULL, '
+            'last_used INTEGER NOT NULL DEFAULT 0, '
+            'uses INTEGER NOT NULL DEFAULT 0'
+            ') WITHOUT ROWID'
+        )
+        # Databases from before usage was tracked
+        columns = {row[1] for row in conn.execute('PRAGMA table_info(entries)')}
+        for column in ('last_used', 'uses'):
+            if column not in columns:
+                conn.execute(f'ALTER TABLE entries ADD COLUMN {column} '
+                             'INTEGER NOT NULL DEFAULT 0')
+
+    def transaction(self, sql: str, rows: Iterable[tuple]):
+        conn = self.connection()
+        conn.execute('BEGIN')
+        try:
+            conn.executemany(sql, rows)
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def read(self, digest: str) -> Optional[Value]:
+        row = self.connection().execute(
+            'SELECT value FROM entries WHERE key = ?', (digest,)
+        ).fetchone()
+        if row is None:
+            return None
+        self.record_use(digest)
+        return row[0]
+
+    def record_use(self, digest: str):
+        with self.uses_lock:
+            # Forked workers start with their parent's pending uses
+            if self.uses_pid != os.getpid():
+                self.uses = Counter()
+                self.uses_pid = os.getpid()
+            self.uses[digest] += 1
+            if len(self.uses) < self.USE_BATCH:
+                return
+            uses, self.uses = self.uses, Counter()
+        self.write_uses(uses)
+
+    def flush(self):
+        with self.uses_lock:
+            if self.uses_pid != os.getpid():
+                return
+            uses, self.uses = self.uses, Counter()
+        if uses:
+            self.write_uses(uses)
+
+    def write_uses(self, uses: Counter):
+        now = int(time.time())
+        self.transaction(
+            'UPDATE entries SET last_used = ?, uses = uses + ? WHERE key = ?',
+            ((now, count, digest) for digest, count in uses.items()),
+        )
+
+    def write(self, digest: str, data: Value):
+        self.connection().execute(
+            'INSERT OR REPLACE INTO entries (key, value, last_used, uses) '
+            'VALUES (?, ?, ?, 1)',
+            (digest, data, int(time.time())),
+        )
+
+    def write_many(self, entries: Iterable[Tuple[str, Value]]):
+        now = int(time.time())
+        self.transaction(
+            'INSERT OR REPLACE INTO entries (key, value, last_used, uses) '
+            'VALUES (?, ?, ?, 1)',
+            ((digest, data, now) for digest, data in entries),
+        )
+
+    def rewrite(self, entries: Iterable[Tuple[str, Value]]):
+        """Replace existing entries' values without counting it as a use."""
+        self.transaction(
+            'UPDATE entries SET value = ? WHERE key = ?',
+            ((data, digest) for digest, data in entries),
+        )
+
+    def items(self) -> Iterator[Tuple[str, Value]]:
+        yield from self.connection().execute('SELECT key, value FROM entries')
+
+    def usage(self) -> Iterator[Usage]:
+        for row in self.connection().execute(
+            'SELECT key, length(CAST(value AS BLOB)), last_used, uses FROM entries'
+        ):
+            yield Usage(*row)
+
+    def delete_many(self, digests: Iterable[str]):
+        self.transaction('DELETE FROM entries WHERE key = ?',
+                         ((digest,) for digest in digests))
+
+    def compact(self):
+        """Give the space freed by deleted entries back to the filesystem."""
+        conn = self.connection()
+        conn.execute('VACUUM')
+        conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+
+class PreloadedBackend:
+    """Another backend's entire contents, held in memory.
+
+    Writes go through to the wrapped backend. Misses are looked up there
+    too, since another process may have written the entry since we loaded.
+    """
 
+    def __init__(self, backend):
+        self.backend = backend
+        self.entries: Dict[str, Value] = {}
 
-def init_cache():
-    if not path.exists(CACHE_DIR):
-        os.mkdir(CACHE_DIR)
+    def init(self):
+        self.backend.init()
+        self.entries = dict(self.backend.items())
+
+    def read(self, digest: str) -> Optional[Value]:
+        data = self.entries.get(digest)
+        if data is None:
+            data = self.backend.read(digest)
+            if data is not None:
+                self.entries[digest] = data
+        else:
+            self.backend.record_use(digest)
+        return data
+
+    def write(self, digest: str, data: Value):
+        self.backend.write(digest, data)
+        self.entries[digest] = data
+
+    def items(self) -> Iterator[Tuple[str, Value]]:
+        return iter(list(self.entries.items()))
+
+    def delete_many(self, digests: Iterable[str]):
+        digests = list(digests)
+        self.backend.delete_many(digests)
+        for digest in digests:
+            self.entries.pop(digest, None)
+
+    def __getattr__(self, name):
+        # Maintenance goes straight to the wrapped backend
+        return getattr(self.backend, name)
+
+
+class Memo:
+    """A bounded LRU of recently used entries, keyed by the unhashed key.
+
+    Sits in front of the backend so that the thousands of repeats of `$t$`
+    in one run cost a dict lookup rather than a hash and a disk read. Hits,
+    misses and evictions are counted in the build profile, if any.
+    """
+
+    def __init__(self, maxsize: int = MEMO_SIZE, name: str = 'memo'):
+        self.maxsize = maxsize
+        self.name = name
+        self.entries: OrderedDict = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key) -> Optional[str]:
+        with self.lock:
+            try:
+                self.entries.move_to_end(key)
+            except KeyError:
+                data = None
+            else:
+                data = self.entries[key]
+        profiling.count(self.name + (' misses' if data is None else ' hits'))
+        return data
+
+    def put(self, key, data: str):
+        if self.maxsize <= 0:
+            return
+        evicted = 0
+        with self.lock:
+            self.entries[key] = data
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                evicted += 1
+        if evicted:
+            profiling.count(self.name + ' evictions', evicted)
+
+
+BACKENDS = {
+    'sqlite': SQLiteBackend,
+    'directory': DirectoryBackend,
+}
+
+_backend = None
+_memo = Memo()
+# Memos of what's computed from entries, by name; see `derived_memo`
+_derived: Dict[str, Memo] = {}
+
+
+POLICIES = {
+    # Least recently used first, and of those the least used
+    'lru': lambda usage: (usage.last_used, usage.uses or 0),
+    # Least used first, and of those the least recently used
+    'lfu': lambda usage: (usage.uses or 0, usage.last_used),
+}
+
+
+def migrate(src: DirectoryBackend, dest: SQLiteBackend) -> int:
+    """Copy every entry of a directory cache into a database."""
+    entries = list(src.items())
+    dest.write_many(entries)
+    return len(entries)
+
+
+def init_cache(backend: str = 'sqlite', memo_size: int = MEMO_SIZE,
+               preload: bool = False):
+    global _backend, _memo
+    flush()
+    _backend = BACKENDS[backend]()
+    _memo = Memo(memo_size)
+    _derived.clear()
+    if isinstance(_backend, SQLiteBackend):
+        fresh = not path.exists(_backend.db_path)
+        _backend.init()
+        if fresh and path.isdir(CACHE_DIR):
+            migrate(DirectoryBackend(), _backend)
+    else:
+        _backend.init()
+
+    if preload:
+        _backend = PreloadedBackend(_backend)
+        _backend.init()
+
+
+def derived_memo(name: str) -> Memo:
+    """A memo for values computed from entries, like the memo of entries.
+
+    It's as big as that memo, and starts out empty again whenever the cache
+    is set up, so nothing computed from a previous cache survives it.
+    """
+    memo = _derived.get(name)
+    if memo is None:
+        memo = _derived[name] = Memo(_memo.maxsize, name)
+    return memo
+
+
+def flush():
+    """Write out the uses recorded since the last write."""
+    if _backend is not None:
+        _backend.flush()
+
+
+atexit.register(flush)
 
 
 def stable_hash(key):
@@ -16,23 +465,22 @@ def stable_hash(key):
     return hashlib.sha512(key).hexdigest()
 
 
-def fname(key):
-    return path.join(CACHE_DIR, stable_hash(key))
-
-
 def in_cache(key):
-    return path.exists(fname(key))
+    return read(key) is not None
 
 
 def write(key, data):
-    with open(fname(key), 'w') as f:
-        f.write(data)
+    _backend.write(stable_hash(key), compress(data))
+    _memo.put(key, data)
 
 def read(key):
-    if in_cache(key):
-        with open(fname(key)) as f:
-            return f.read()
-    return None
+    ret = _memo.get(key)
+    if ret is None:
+        value = _backend.read(stable_hash(key))
+        if value is not None:
+            ret = decompress(value)
+            _memo.put(key, ret)
+    return ret
 
 def ensure(key, compute_data):
     ret = read(key)
@@ -40,3 +488,135 @@ def ensure(key, compute_data):
         ret = compute_data(key)
         write(key, ret)
     return ret
+
+
+@dataclass
+class GCResult:
+    compressed: int = 0
+    evicted: int = 0
+    freed: int = 0
+    remaining: int = 0
+
+
+def compress_all(backend) -> int:
+    """Compress the entries written before compression."""
+    entries = [(digest, compress(decompress(value)))
+               for digest, value in backend.items()
+               if not is_compressed(value)]
+    backend.rewrite(entries)
+    return len(entries)
+
+
+def gc(backend, max_size: Optional[int] = None, policy: str = 'lru') -> GCResult:
+    """Compress old entries, then evict by `policy` until under `max_size` bytes."""
+    backend.flush()
+    result = GCResult(compressed=compress_all(backend))
+    usage = sorted(backend.usage(), key=POLICIES[policy])
+    total = sum(entry.size for entry in usage)
+    evict: List[str] = []
+    for entry in usage:
+        if max_size is None or total <= max_size:
+            break
+        evict.append(entry.digest)
+        total -= entry.size
+        result.freed += entry.size
+    backend.delete_many(evict)
+    if result.compressed or evict:
+        backend.compact()
+    result.evicted = len(evict)
+    result.remaining = total
+    return result
+
+
+def delete_matching(predicate: Callable[[str], bool]) -> int:
+    """Delete the entries whose values `predicate` accepts."""
+    digests = [digest for digest, value in _backend.items()
+               if predicate(decompress(value))]
+    _backend.delete_many(digests)
+    return len(digests)
+
+
+def collect(max_size: int) -> GCResult:
+    """`gc` the cache `init_cache` opened, least recently used first."""
+    return gc(_backend, max_size, 'lru')
+
+
+def format_size(size: int) -> str:
+    return f'{size / 2**20:.2f} MiB'
+
+
+def print_stats(backend):
+    backend.flush()
+    count = stored = raw = uncompressed = 0
+    for _, value in backend.items():
+        count += 1
+        stored += len(value if isinstance(value, bytes) else value.encode('utf-8'))
+        raw += len(decompress(value).encode('utf-8'))
+        uncompressed += not is_compressed(value)
+    print(f'Entries:           {count}')
+    print(f'Stored:            {format_size(stored)}')
+    print(f'Uncompressed:      {format_size(raw)}'
+          + (f' ({raw / stored:.1f}x)' if stored else ''))
+    if uncompressed:
+        print(f'Not compressed:    {uncompressed} (run gc to compress)')
+
+    usage = list(backend.usage())
+    if not usage:
+        return
+    now = time.time()
+    last_used = sorted(entry.last_used for entry in usage)
+    print(f'Least recent use:  {(now - last_used[0]) / 86400:.1f} days ago')
+    print(f'Most recent use:   {(now - last_used[-1]) / 86400:.1f} days ago')
+    if usage[0].uses is not None:
+        uses = sorted(entry.uses for entry in usage)
+        print(f'Uses (median/max): {uses[len(uses) // 2]}/{uses[-1]}')
+        print(f'Used once:         {sum(1 for u in uses if u <= 1)}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Manage the formula cache.')
+    parser.add_argument('--backend', choices=sorted(BACKENDS), default='sqlite',
+                        help='which cache to manage (default: sqlite)')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+    subparsers.add_parser(
+        'migrate',
+        help=f'copy the {CACHE_DIR}/ directory cache into {CACHE_DB}',
+    )
+    subparsers.add_parser(
+        'stats',
+        help='show how many entries there are, how big, and how used',
+    )
+    gc_parser = subparsers.add_parser(
+        'gc',
+        help='compress old entries and evict entries beyond a size limit',
+    )
+    gc_parser.add_argument('--max-size', type=parse_size,
+                           help='evict entries until the cache is at most '
+                           'this big, like 20M (default: no limit)')
+    gc_parser.add_argument('--policy', choices=sorted(POLICIES), default='lru',
+                           help='which entries to evict first: least recently '
+                           'used, or least often used (default: lru)')
+    args = parser.parse_args()
+
+    if args.command == 'migrate':
+        dest = SQLiteBackend()
+        dest.init()
+        count = migrate(DirectoryBackend(), dest)
+        print(f'Migrated {count} entries from {CACHE_DIR} to {CACHE_DB}')
+        return
+
+    if args.command == 'gc' and args.policy == 'lfu' and args.backend == 'directory':
+        parser.error("the directory backend doesn't count uses; use --policy lru")
+    backend = BACKENDS[args.backend]()
+    backend.init()
+    if args.command == 'stats':
+        print_stats(backend)
+    elif args.command == 'gc':
+        result = gc(backend, args.max_size, args.policy)
+        print(f'Compressed {result.compressed} entries, evicted {result.evicted} '
+              f'({format_size(result.freed)}), {format_size(result.remaining)} left')
+
+
+if __name__ == '__main__':
+    main()
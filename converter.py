@@ -0,0 +1,288 @@
+"""Runs TeX through SnuggleTeX.
+
+Starting a JVM for every formula dominates cold builds, so when the
+`snuggletex-server` wrapper (see `snuggletex/SnuggleServer.java`) is on the
+`PATH` we keep a small pool of resident converters and talk to them over
+stdin/stdout. Otherwise we fall back to running `snuggletex -` once per
+formula.
+
+Either way, `run` returns a `subprocess.CompletedProcess` with the same
+`returncode`, `stdout` and `stderr` the one-shot command would have produced.
+"""
+
+import asyncio
+import atexit
+import functools
+import os
+import queue
+import re
+import shutil
+import subprocess
+import threading
+from typing import List, Optional
+
+ONESHOT_COMMAND = ['snuggletex', '-']
+SERVER_COMMAND = ['snuggletex-server']
+
+# Give up on resident servers once this many have died on formulas the
+# one-shot command then rendered fine, since each costs two JVM starts
+MAX_SERVER_FAILURES = 3
+
+JAR_VERSION = re.compile(r'snuggletex-core-([0-9][0-9A-Za-z.-]*)\.jar')
+
+
+class ServerDied(Exception):
+    pass
+
+
+# Left in a pool's idle queue when a server is retired
+SLOT_FREED = object()
+
+
+class Server:
+    """A single resident SnuggleTeX process."""
+
+    def __init__(self, args: List[str] = SERVER_COMMAND):
+        self.args = args
+        self.proc = subprocess.Popen(
+            args,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+
+    def run(self, tex: str) -> subprocess.CompletedProcess:
+        request = tex.encode('utf-8')
+        try:
+            self.proc.stdin.write(b'%d\n' % len(request))
+            self.proc.stdin.write(request)
+            self.proc.stdin.flush()
+
+            header = self.proc.stdout.readline()
+            if not header:
+                raise ServerDied(self.args)
+            returncode, out_len, err_len = map(int, header.split())
+            stdout = self._read_exactly(out_len)
+            stderr = self._read_exactly(err_len)
+        except (BrokenPipeError, ValueError) as e:
+            raise ServerDied(self.args) from e
+
+        return subprocess.CompletedProcess(
+            args=ONESHOT_COMMAND,
+            returncode=returncode,
+            stdout=stdout.decode('utf-8'),
+            stderr=stderr.decode('utf-8'),
+        )
+
+    def _read_exactly(self, n: int) -> bytes:
+        data = self.proc.stdout.read(n)
+        if len(data) != n:
+            raise ServerDied(self.args)
+        return data
+
+    def close(self):
+        try:
+            self.proc.stdin.close()
+        except BrokenPipeError:
+            pass
+        try:
+            self.proc.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+            self.proc.wait()
+
+
+class Pool:
+    """Up to `size` resident servers, shared between threads.
+
+    If they can't be started, or keep dying on formulas the one-shot command
+    has no trouble with, every formula goes to the one-shot command instead.
+    """
+
+    def __init__(self, size: int = 1):
+        self.size = size
+        self.idle = queue.LifoQueue()
+        self.started = 0
+        self.servers = []
+        self.failures = 0
+        self.disabled = False
+        self.lock = threading.Lock()
+
+    def _checkout(self) -> Optional[Server]:
+        """A server to use, or None if the pool has been disabled."""
+        while True:
+            with self.lock:
+                if self.idle.empty() and self.started < self.size:
+                    # Only counted once it's running, so a failure can't
+                    # leak a slot
+                    server = Server()
+                    self.started += 1
+                    self.servers.append(server)
+                    return server
+            server = self.idle.get()
+            if server is None:
+                # Pass it on to the next thread waiting
+                self.idle.put(None)
+                return None
+            if server is not SLOT_FREED:
+                return server
+
+    def _disable(self):
+        with self.lock:
+            self.disabled = True
+        while True:
+            try:
+                server = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            if isinstance(server, Server):
+                self._retire(server)
+        # Wakes every thread waiting for a server, one after another
+        self.idle.put(None)
+
+    def _retire(self, server: Server):
+        with self.lock:
+            self.servers.remove(server)
+            self.started -= 1
+        # Whoever's waiting for a server can start one instead
+        self.idle.put(SLOT_FREED)
+        server.close()
+
+    def run(self, tex: str) -> subprocess.CompletedProcess:
+        if self.disabled:
+            return run_oneshot(tex)
+        try:
+            server = self._checkout()
+        except OSError:
+            self._disable()
+            return run_oneshot(tex)
+        if server is None:
+            return run_oneshot(tex)
+        try:
+            ret = server.run(tex)
+        except ServerDied:
+            # The CLI is allowed to exit() on bad input; a fresh JVM running
+            # the one-shot command reports that exactly like it always has.
+            self._retire(server)
+            ret = run_oneshot(tex)
+            if ret.returncode == 0:
+                # Not bad input, then, but a bad server
+                with self.lock:
+                    self.failures += 1
+                    give_up = self.failures >= MAX_SERVER_FAILURES
+                if give_up:
+                    self._disable()
+            return ret
+        except BaseException:
+            # We can't tell where in the exchange it stopped, so don't
+            # trust it with another formula; leaking it would stall _checkout
+            self._retire(server)
+            raise
+        if self.disabled:
+            self._retire(server)
+        else:
+            self.idle.put(server)
+        return ret
+
+    def close(self):
+        with self.lock:
+            servers, self.servers = self.servers, []
+            self.started = 0
+        for server in servers:
+            server.close()
+
+
+def run_oneshot(tex: str) -> subprocess.CompletedProcess:
+    return subprocess.run(
+        ONESHOT_COMMAND,
+        input=tex,
+        capture_output=True,
+        text=True,
+        encoding='utf-8',
+    )
+
+
+@functools.lru_cache()
+def version() -> str:
+    """Which SnuggleTeX we're running, read from the jar the wrapper runs."""
+    wrapper = shutil.which(ONESHOT_COMMAND[0])
+    if wrapper is not None:
+        try:
+            with open(wrapper, errors='replace') as f:
+                match = JAR_VERSION.search(f.read())
+        except OSError:
+            match = None
+        if match:
+            return 'snuggletex-' + match.group(1)
+    return 'snuggletex-unknown'
+
+
+_pool: Optional[Pool] = None
+_pool_pid: Optional[int] = None
+_pool_size = 1
+_pool_lock = threading.Lock()
+
+
+def configure(size: int):
+    """Set the number of resident servers; 0 disables them."""
+    global _pool_size
+    close()
+    _pool_size = size
+
+
+def _get_pool() -> Optional[Pool]:
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool_pid != os.getpid():
+            # Forked children must not share their parent's pipes
+            _pool = None
+            _pool_pid = os.getpid()
+            if _pool_size > 0 and shutil.which(SERVER_COMMAND[0]):
+                _pool = Pool(_pool_size)
+        return _pool
+
+
+def run(tex: str) -> subprocess.CompletedProcess:
+    pool = _get_pool()
+    if pool is None:
+        return run_oneshot(tex)
+    return pool.run(tex)
+
+
+async def run_async(tex: str) -> subprocess.CompletedProcess:
+    """Like `run`, but waits on the converter without blocking the loop.
+
+    Resident servers are synchronous, so requests to them run on the loop's
+    default executor; the one-shot command runs as an asyncio subprocess.
+    """
+    pool = _get_pool()
+    if pool is not None:
+        return await asyncio.get_event_loop().run_in_executor(None, pool.run, tex)
+
+    proc = await asyncio.create_subprocess_exec(
+        *ONESHOT_COMMAND,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    try:
+        stdout, stderr = await proc.communicate(tex.encode('utf-8'))
+    except asyncio.CancelledError:
+        proc.kill()
+        raise
+    return subprocess.CompletedProcess(
+        args=ONESHOT_COMMAND,
+        returncode=proc.returncode,
+        stdout=stdout.decode('utf-8'),
+        stderr=stderr.decode('utf-8'),
+    )
+
+
+def close():
+    global _pool, _pool_pid
+    if _pool is not None and _pool_pid == os.getpid():
+        _pool.close()
+    _pool = None
+    _pool_pid = None
+
+
+atexit.register(close)
@@ -11,6 +11,10 @@ stdenv.mkDerivation rec {
     ./process_book_html.py
     ./epub.py
     ./cache.py
+    ./converter.py
+    ./profiling.py
+    ./fasttex.py
+    ./xhtml.py
   ];
 
   srcs = [
@@ -19,7 +23,6 @@ stdenv.mkDerivation rec {
 
   unpackPhase =
     ''
-      unpackFile $bookSource
       for fn in $pySources
       do
         cp "$fn" "$(stripHash "$fn")"
@@ -41,14 +44,13 @@ stdenv.mkDerivation rec {
       (import ./ebooklib.nix {inherit pkgs; pythonPackages = p;})
     ]))
     (import ./snuggletex.nix {inherit pkgs;})
-    (import ./html2xhtml.nix {inherit pkgs;})
   ];
 
   dontConfigure = true;
   buildPhase =
     ''
-      ./process_book_html.py
-      ./epub.py
+      ./process_book_html.py --source $bookSource --staging staging.zip --xhtml
+      ./epub.py --staging staging.zip
       mkdir $out
       mv information-retrieval.epub $out/
     '';
@@ -2,12 +2,59 @@
 
 from os import path
 import os
+import argparse
+import json
+import multiprocessing
+from typing import Iterable, List, Optional, Set
+from urllib.parse import urlsplit, unquote
+
+import lxml.html
+from termcolor import cprint
 
 import process_book_html
 
-def main():
+
+def page_links(fname: str) -> Iterable[str]:
+    metadata_fname = process_book_html.metadata_filename(fname)
+    if path.exists(metadata_fname):
+        with open(metadata_fname, encoding='utf-8') as f:
+            metadata = json.load(f)
+        return metadata['images'] + metadata['links']
+    return (link for el, attr, link, pos
+            in lxml.html.parse(fname).getroot().iterlinks())
+
+
+def page_references(fname: str) -> Set[str]:
+    """Normalized paths of the local files a page links to or embeds.
+
+    Uses the page's metadata sidecar when there is one, rather than
+    parsing the page.
+    """
+    page_dir = path.dirname(fname)
+    refs = set()
+    for link in page_links(fname):
+        url = urlsplit(link)
+        if url.scheme or url.netloc or not url.path:
+            continue
+        refs.add(path.normpath(path.join(page_dir, unquote(url.path))))
+    return refs
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description='Delete images in the output directory no page refers to.'
+    )
+    parser.add_argument('-n', '--dry-run', action='store_true',
+                        help="list what would be deleted, but don't delete it")
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of pages to scan in parallel')
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None):
+    args = parse_args(argv)
     out_files = [
-        path.join(process_book_html.OUTPUT_DIR, p)
+        path.normpath(path.join(process_book_html.OUTPUT_DIR, p))
         for p in sorted(os.listdir(process_book_html.OUTPUT_DIR))
     ]
 
@@ -19,20 +66,28 @@ def main():
         p for p in out_files if p.endswith('.html')
     ]
 
-    for fn in html_files:
-        txt = process_book_html.read(fn)
-        remove_images = set()
+    referenced = set()
+    if args.jobs > 1:
+        with multiprocessing.Pool(args.jobs) as pool:
+            for refs in pool.imap_unordered(page_references, html_files, chunksize=16):
+                referenced.update(refs)
+    else:
+        for fn in html_files:
+            referenced.update(page_references(fn))
 
-        for img in images:
-            if path.basename(img) in txt:
-                # the image's file is mentioned in the page
-                remove_images.add(img)
+    unused = sorted(images - referenced)
+    reclaimed = 0
+    for image in unused:
+        reclaimed += path.getsize(image)
+        if args.dry_run:
+            print(image)
+        else:
+            os.remove(image)
 
-        if len(remove_images) > 0:
-            images.difference_update(remove_images)
+    verb = 'Would delete' if args.dry_run else 'Deleted'
+    cprint(f'{verb} {len(unused)} of {len(images)} images, '
+           f'{reclaimed / 2**20:.1f} MiB', 'green', attrs=['bold'])
 
-    for image in images:
-        os.remove(image)
 
 if __name__ == '__main__':
     main()
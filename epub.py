@@ -3,10 +3,15 @@
 import os
 from os import path
 import uuid
-from typing import List, Tuple, Optional, Union
+import argparse
+import datetime
+import functools
+import json
+import shutil
+import zipfile
+from typing import BinaryIO, Callable, List, Tuple, Optional, Union
 import sys
 
-from bs4 import BeautifulSoup
 import ebooklib
 from ebooklib import epub
 from termcolor import cprint, colored
@@ -22,13 +27,28 @@ published = '2008-07-01'
 publisher = 'Cambridge University Press'
 cover_fname = 'cover.jpg'
 contents_fname = 'contents-1.html'
+index_fname = 'irbook.html'
 output_filename = 'information-retrieval.epub'
 css_filename = 'book.css'
 
-MATH_ELEMENT = '<math xmlns="http://www.w3.org/1998/Math/MathML">'
+# Already compressed; deflating them again only costs time
+STORED_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif')
 
-def get_uuid() -> str:
-    return 'b' + uuid.uuid1().hex
+def get_uuid(file_name: str) -> str:
+    """An item id derived from the book and the item's file name."""
+    return 'b' + uuid.uuid5(uuid.UUID(book_uuid), file_name).hex
+
+
+def modified_time() -> datetime.datetime:
+    """The time the book records as its last modification.
+
+    Taken from `SOURCE_DATE_EPOCH` when it's set, and otherwise fixed at
+    the publication date, so that the same inputs give the same bytes.
+    """
+    epoch = os.environ.get('SOURCE_DATE_EPOCH')
+    if epoch:
+        return datetime.datetime.fromtimestamp(int(epoch), datetime.timezone.utc)
+    return datetime.datetime.strptime(published, '%Y-%m-%d')
 
 
 TocEntry = Union[
@@ -39,32 +59,34 @@ TocList = List[TocEntry]
 UUIDList = List[str]
 
 
-def generate_toc(contents: BeautifulSoup, uids: dict) -> (TocList, UUIDList):
-    def make_toc_li(li: BeautifulSoup, toc: TocList):
-        href = li.a['href']
+def generate_toc(contents: List[dict], uids: dict,
+                 html_files: List[str]) -> (TocList, UUIDList):
+    """Build the TOC from the contents page's outline (see `chapter_metadata`)."""
+    def make_toc_li(entry: dict, toc: TocList):
+        href = entry['href']
         link = epub.Link(
             href=href,
-            title=str(li.a.string),
+            title=entry['title'],
             uid=uids[href],
         )
         spine.append(uids[href])
         not_added_html_files.discard(href)
 
-        if li.ul:
+        if entry['children']:
             sub_toc = []
             toc.append((link, sub_toc))
-            make_toc_ul(li.ul, sub_toc)
+            make_toc_ul(entry['children'], sub_toc)
         else:
             toc.append(link)
 
-    def make_toc_ul(ul: BeautifulSoup, toc: TocList):
-        for li in ul.find_all('li', recursive=False):
-            make_toc_li(li, toc)
+    def make_toc_ul(entries: List[dict], toc: TocList):
+        for entry in entries:
+            make_toc_li(entry, toc)
 
     irbook = epub.Link(
-        uid=uids['irbook.html'],
-        href='irbook.html',
-        title='Introduction to Information Retrieval',
+        uid=uids[index_fname],
+        href=index_fname,
+        title=title,
     )
     toc = [irbook]
     spine = [
@@ -72,28 +94,168 @@ def generate_toc(contents: BeautifulSoup, uids: dict) -> (TocList, UUIDList):
         irbook.uid
     ]
 
-    not_added_html_files = set(map(path.basename, process_book_html.output_files('.html')))
+    not_added_html_files = set(html_files)
     not_added_html_files.discard(irbook.href)
-    make_toc_ul(contents.find('ul'), toc)
-    spine.extend(map(uids.__getitem__, not_added_html_files))
+    make_toc_ul(contents, toc)
+    spine.extend(map(uids.__getitem__, sorted(not_added_html_files)))
 
     return toc, spine
 
 
-def get_toc(uids: dict) -> (TocList, UUIDList):
-    contents_soup = process_book_html.soup(output_path(contents_fname))
-    return generate_toc(contents_soup, uids)
-
-
-def doc_title(html: str) -> str:
-    soup = BeautifulSoup(html, 'lxml')
-    return str(soup.find('title').string)
+def get_toc(uids: dict, output: 'OutputDirectory') -> (TocList, UUIDList):
+    contents = output.metadata(contents_fname)
+    return generate_toc(contents['toc'], uids, output.names('.html'))
 
 def output_path(p: str) -> str:
     return path.join(process_book_html.OUTPUT_DIR, p)
 
 
-def make_epub() -> epub.EpubBook:
+Opener = Callable[[], BinaryIO]
+
+
+class OutputDirectory:
+    """The pages and images `process_book_html` left in `OUTPUT_DIR`."""
+
+    def names(self, ext: str) -> List[str]:
+        return [path.basename(p) for p in process_book_html.output_files(ext)]
+
+    def opener(self, name: str) -> Opener:
+        return functools.partial(open, output_path(name), 'rb')
+
+    def metadata(self, name: str) -> dict:
+        return process_book_html.load_metadata(output_path(name))
+
+
+class StagedOutput:
+    """The same, from the zip `process_book_html.py --staging` wrote."""
+
+    def __init__(self, fname: str):
+        self.zip = zipfile.ZipFile(fname)
+
+    def names(self, ext: str) -> List[str]:
+        return sorted(name for name in self.zip.namelist() if name.endswith(ext))
+
+    def opener(self, name: str) -> Opener:
+        return functools.partial(self.zip.open, name)
+
+    def metadata(self, name: str) -> dict:
+        return json.loads(self.zip.read(process_book_html.metadata_filename(name)))
+
+
+class FileContent:
+    """Mixin for items whose content stays in the output until it's written."""
+
+    def __init__(self, *args, source: Optional[Opener] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.source = source
+
+    def read_source(self) -> Union[str, bytes]:
+        with self.source() as f:
+            return f.read()
+
+    @property
+    def content(self):
+        if getattr(self, 'source', None) is None:
+            return self._content
+        return self.read_source()
+
+    @content.setter
+    def content(self, content):
+        self._content = content
+
+
+class FileHtml(FileContent, epub.EpubHtml):
+    def read_source(self) -> str:
+        return process_book_html.decode(super().read_source())
+
+
+class FileItem(FileContent, epub.EpubItem):
+    pass
+
+
+class ReproducibleZipFile(zipfile.ZipFile):
+    """A zip whose entries don't record when, where or by whom it was made."""
+
+    def __init__(self, *args, date_time: Tuple[int, ...], **kwargs):
+        super().__init__(*args, **kwargs)
+        self.date_time = date_time
+
+    def zipinfo(self, arcname: str, compress_type: Optional[int] = None) -> zipfile.ZipInfo:
+        zinfo = zipfile.ZipInfo(arcname, date_time=self.date_time)
+        zinfo.compress_type = self.compression if compress_type is None else compress_type
+        zinfo.create_system = 3
+        zinfo.external_attr = 0o644 << 16
+        return zinfo
+
+    def writestr(self, zinfo_or_arcname, data, compress_type=None, compresslevel=None):
+        if not isinstance(zinfo_or_arcname, zipfile.ZipInfo):
+            zinfo_or_arcname = self.zipinfo(zinfo_or_arcname, compress_type)
+        super().writestr(zinfo_or_arcname, data, compress_type=compress_type,
+                         compresslevel=compresslevel or self.compresslevel)
+
+    def copy_stored(self, source: Opener, arcname: str):
+        """Copy the file `source` opens in uncompressed, a chunk at a time."""
+        with source() as src, \
+             self.open(self.zipinfo(arcname, zipfile.ZIP_STORED), 'w') as dest:
+            shutil.copyfileobj(src, dest)
+
+
+class BookWriter(epub.EpubWriter):
+    """Writes each item into the archive in turn, holding at most one.
+
+    Items backed by a file that ebooklib doesn't need to rewrite are copied
+    into the zip in chunks, never read whole. Images are stored rather than
+    deflated, and a `compresslevel` of 0 stores everything. Every entry gets
+    the timestamp from the `mtime` option, so the archive is reproducible.
+    """
+
+    def write(self):
+        level = self.options['compresslevel']
+        self.out = ReproducibleZipFile(
+            self.file_name, 'w',
+            zipfile.ZIP_DEFLATED if level else zipfile.ZIP_STORED,
+            compresslevel=level or None,
+            date_time=self.options['mtime'].timetuple()[:6],
+        )
+        self.out.writestr('mimetype', 'application/epub+zip',
+                          compress_type=zipfile.ZIP_STORED)
+        self._write_container()
+        self._write_opf()
+        self._write_items()
+        self.out.close()
+
+    def _write_items(self):
+        for item in self.book.get_items():
+            name = item.file_name
+            if item.manifest:
+                name = f'{self.book.FOLDER_NAME}/{name}'
+            compress_type = None
+            if name.lower().endswith(STORED_EXTENSIONS):
+                compress_type = zipfile.ZIP_STORED
+
+            source = getattr(item, 'source', None)
+            if isinstance(item, epub.EpubNcx):
+                data = self._get_ncx()
+            elif isinstance(item, epub.EpubNav):
+                data = self._get_nav(item)
+            elif (source is not None and not isinstance(item, epub.EpubHtml)
+                  and compress_type == zipfile.ZIP_STORED):
+                self.out.copy_stored(source, name)
+                continue
+            else:
+                data = item.get_content()
+            self.out.writestr(name, data, compress_type=compress_type)
+
+
+def make_epub(streaming: bool = False,
+              output: Optional[Union[OutputDirectory, StagedOutput]] = None) -> epub.EpubBook:
+    """Assemble the book from `output`, by default the output directory.
+
+    With `streaming`, pages and images are left where they are and only read
+    when `write_book` writes them, so the whole book is never in memory at
+    once.
+    """
+    output = output or OutputDirectory()
     book = epub.EpubBook()
     book.set_identifier(book_uuid)
     book.set_language(language)
@@ -104,54 +266,69 @@ def make_epub() -> epub.EpubBook:
         cover_fname: 'cover-image',
     }
 
-    with open(output_path(cover_fname), 'rb') as f:
-        book.set_cover(
-            file_name=cover_fname,
-            content=f.read(),
-        )
+    if streaming:
+        book.set_cover(file_name=cover_fname, content=b'')
+        book.get_item_with_id('cover-img').source = output.opener(cover_fname)
+    else:
+        with output.opener(cover_fname)() as f:
+            book.set_cover(
+                file_name=cover_fname,
+                content=f.read(),
+            )
 
-    for filename in process_book_html.output_files('.html'):
-        uid = get_uuid()
-        uids[path.basename(filename)] = uid
+    for filename in output.names('.html'):
+        uid = get_uuid(filename)
+        uids[filename] = uid
 
-        content = process_book_html.read(filename)
-        chapter = epub.EpubHtml(
+        metadata = output.metadata(filename)
+        html_args = dict(
             uid=uid,
-            title=doc_title(content),
-            file_name=path.basename(filename),
+            title=metadata['title'],
+            file_name=filename,
             lang=language,
-            content=content,
             media_type='application/xhtml+xml',
         )
-        if MATH_ELEMENT in content:
+        if streaming:
+            chapter = FileHtml(source=output.opener(filename), **html_args)
+        else:
+            with output.opener(filename)() as f:
+                content = process_book_html.decode(f.read())
+            chapter = epub.EpubHtml(content=content, **html_args)
+        if metadata['mathml']:
             chapter.properties.append('mathml')
         book.add_item(chapter)
 
-    for filename in process_book_html.output_files('.png'):
-        uid = get_uuid()
-        uids[path.basename(filename)] = uid
+    for filename in output.names('.png'):
+        uid = get_uuid(filename)
+        uids[filename] = uid
 
-        with open(filename, 'rb') as f:
-            img_data = f.read()
-            img = epub.EpubItem(
-                file_name=path.basename(filename),
-                content=img_data,
+        if streaming:
+            img = FileItem(
+                file_name=filename,
+                source=output.opener(filename),
                 uid=uid,
             )
-            book.add_item(img)
+        else:
+            with output.opener(filename)() as f:
+                img = epub.EpubItem(
+                    file_name=filename,
+                    content=f.read(),
+                    uid=uid,
+                )
+        book.add_item(img)
 
     with open(css_filename) as css:
         uids[css_filename] = 'book_css'
         css_content = css.read()
         css_item = epub.EpubItem(
             uid=uids[css_filename],
-            file_name=path.join('Styles', css_filename),
+            file_name=process_book_html.STYLESHEET_HREF,
             media_type='text/css',
             content=css_content,
         )
         book.add_item(css_item)
 
-    book.toc, book.spine = get_toc(uids)
+    book.toc, book.spine = get_toc(uids, output)
 
     book.add_item(epub.EpubNcx())
     book.add_item(epub.EpubNav())
@@ -166,23 +343,57 @@ def check_book(book):
                 cprint(f'Item {item} has bad {attr} {getattr(item, attr)}', 'red', attrs=['bold'])
     return found_bad
 
-def main():
+def write_book(book: epub.EpubBook, filename: Optional[str] = None,
+               compress_level: int = 6):
+    filename = filename or output_filename
+    options = {
+        'play_order':  {'enabled': True, 'start_from': 1},
+        'compresslevel': compress_level,
+        'mtime': modified_time(),
+    }
+    writer = BookWriter(filename, book, options)
+    writer.process()
+    writer.write()
+
+
+def compress_level(s: str) -> int:
+    if s == 'stored':
+        return 0
+    level = int(s)
+    if not 0 <= level <= 9:
+        raise argparse.ArgumentTypeError('must be between 0 and 9, or "stored"')
+    return level
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=f'Assemble {output_filename}.')
+    parser.add_argument('--stream', action='store_true',
+                        help='read pages and images from disk as they are written, '
+                        'rather than loading the whole book first')
+    parser.add_argument('--staging', metavar='ZIP',
+                        help='read the pages and images from the zip written by '
+                        'process_book_html.py --staging, rather than from '
+                        f'{process_book_html.OUTPUT_DIR}/')
+    parser.add_argument('--compress-level', type=compress_level, default=6,
+                        metavar='{0-9,stored}',
+                        help='deflate level for the archive (default: 6); '
+                        'images are always stored uncompressed')
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None):
+    args = parse_args(argv)
     # if path.exists(output_filename):
     #     cprint(f'Output file {output_filename} already exists, refusing to overwrite',
     #            'red', attrs=['bold'])
     #     sys.exit(1)
 
-    book = make_epub()
+    output = StagedOutput(args.staging) if args.staging else None
+    book = make_epub(streaming=args.stream, output=output)
     if check_book(book):
         sys.exit(1)
 
-    epub.write_epub(
-        output_filename,
-        book,
-        {
-            'play_order':  {'enabled': True, 'start_from': 1}
-        }
-    )
+    write_book(book, compress_level=args.compress_level)
     cprint(f'Wrote {output_filename} successfully!', 'green', attrs=['bold'])
 
 if __name__ == '__main__':
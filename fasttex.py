@@ -0,0 +1,185 @@
+"""Renders the simplest of the book's TeX to MathML without SnuggleTeX.
+
+Most formulas in the book are things like `$t$`, `$x_i$` or `$\\alpha$`,
+and asking SnuggleTeX for those costs far more than writing the MathML out
+ourselves. `render` handles a small, fixed subset of inline math and
+returns None for anything else, which then goes to SnuggleTeX as usual:
+
+- Latin letters, and the lowercase Greek letters in `GREEK`
+- unsigned numbers, like `42` or `0.5`
+- the operators in `OPERATORS`
+- a subscript, a superscript or both on a letter or number, where each is
+  a single one of the above or a braced run of them
+
+The output is meant to be byte-identical to SnuggleTeX's, but that's only
+as true as the last check against the SnuggleTeX actually in use, so nothing
+here is used unless `enable` is called. With `verify`, every formula the
+fast path handles is also converted by SnuggleTeX and the two compared
+(`process_book_html.py --verify-fast-tex`); do that for a book, and a new
+SnuggleTeX, before building it with `--fast-tex`.
+"""
+
+import re
+from typing import List, Optional, Tuple
+
+MATH_START = '<math xmlns="http://www.w3.org/1998/Math/MathML">'
+MATH_END = '</math>'
+
+GREEK = {
+    'alpha': 'α',
+    'beta': 'β',
+    'gamma': 'γ',
+    'delta': 'δ',
+    'zeta': 'ζ',
+    'eta': 'η',
+    'theta': 'θ',
+    'iota': 'ι',
+    'kappa': 'κ',
+    'lambda': 'λ',
+    'mu': 'μ',
+    'nu': 'ν',
+    'xi': 'ξ',
+    'pi': 'π',
+    'rho': 'ρ',
+    'sigma': 'σ',
+    'tau': 'τ',
+    'upsilon': 'υ',
+    'chi': 'χ',
+    'psi': 'ψ',
+    'omega': 'ω',
+}
+OPERATORS = '+=,'
+
+TOKEN = re.compile(r'''\s*(?:
+    (?P<mi>[a-zA-Z])
+  | (?P<mn>[0-9]+(?:\.[0-9]+)?)
+  | (?P<mo>[''' + re.escape(OPERATORS) + r'''])
+  | \\(?P<command>[a-zA-Z]+)
+  | (?P<syntax>[_^{}])
+)''', re.VERBOSE)
+TRAILING_SPACE = re.compile(r'\s*$')
+
+Token = Tuple[str, str]
+
+_enabled = False
+_verify = False
+
+
+def enable(verify: bool = False):
+    global _enabled, _verify
+    _enabled = True
+    _verify = verify
+
+
+def enabled() -> bool:
+    return _enabled
+
+
+def verifying() -> bool:
+    return _verify
+
+
+def tokenize(math: str) -> Optional[List[Token]]:
+    tokens = []
+    pos = 0
+    while not TRAILING_SPACE.match(math, pos):
+        m = TOKEN.match(math, pos)
+        if m is None:
+            return None
+        pos = m.end()
+        kind = m.lastgroup
+        text = m.group(kind)
+        if kind == 'command':
+            if text not in GREEK:
+                return None
+            kind, text = 'mi', GREEK[text]
+        tokens.append((kind, text))
+    return tokens
+
+
+class _Parser:
+    def __init__(self, tokens: List[Token]):
+        self.tokens = tokens
+        self.pos = 0
+
+    def peek(self) -> Optional[Token]:
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return None
+
+    def atom(self) -> Optional[str]:
+        token = self.peek()
+        if token is None or token[0] == 'syntax':
+            return None
+        self.pos += 1
+        kind, text = token
+        return f'<{kind}>{text}</{kind}>'
+
+    def script(self) -> Optional[str]:
+        """A script's argument: one atom, or a braced run of them."""
+        if self.peek() != ('syntax', '{'):
+            return self.atom()
+        self.pos += 1
+        atoms = []
+        while self.peek() != ('syntax', '}'):
+            atom = self.atom()
+            if atom is None:
+                return None
+            atoms.append(atom)
+        self.pos += 1
+        return mrow(atoms)
+
+    def item(self) -> Optional[str]:
+        token = self.peek()
+        base = self.atom()
+        if base is None:
+            return None
+        scripts = {}
+        while self.peek() in (('syntax', '_'), ('syntax', '^')):
+            if token[0] == 'mo':
+                return None
+            which = self.peek()[1]
+            if which in scripts:
+                return None
+            self.pos += 1
+            scripts[which] = self.script()
+            if scripts[which] is None:
+                return None
+
+        if '_' in scripts and '^' in scripts:
+            return f'<msubsup>{base}{scripts["_"]}{scripts["^"]}</msubsup>'
+        elif '_' in scripts:
+            return f'<msub>{base}{scripts["_"]}</msub>'
+        elif '^' in scripts:
+            return f'<msup>{base}{scripts["^"]}</msup>'
+        return base
+
+    def parse(self) -> Optional[str]:
+        items = []
+        while self.peek() is not None:
+            item = self.item()
+            if item is None:
+                return None
+            items.append(item)
+        return mrow(items)
+
+
+def mrow(items: List[str]) -> Optional[str]:
+    if not items:
+        return None
+    if len(items) == 1:
+        return items[0]
+    return '<mrow>' + ''.join(items) + '</mrow>'
+
+
+def render(tex: str) -> Optional[str]:
+    """MathML for normalized inline `tex`, or None if it's outside the subset."""
+    if len(tex) < 3 or tex[0] != '$' or tex[-1] != '$' or '$' in tex[1:-1]:
+        return None
+    tokens = tokenize(tex[1:-1])
+    if tokens is None:
+        return None
+    body = _Parser(tokens).parse()
+    if body is None:
+        return None
+    return MATH_START + body + MATH_END
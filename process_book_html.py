@@ -1,25 +1,53 @@
 #!/usr/bin/env python3.7
 
 import subprocess
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from os import path
 import os
 import re
-from typing import Optional, List
+from typing import AsyncIterator, Callable, Dict, Iterable, Iterator, Optional, List, Set, TextIO, Tuple, Union
 import difflib
 import sys
-import math
 import itertools
+import argparse
+import asyncio
+import collections
+import multiprocessing
+import concurrent.futures
+import contextlib
+import functools
+import hashlib
+import io
+import json
+import tarfile
+import tempfile
+import zipfile
 
 from bs4 import BeautifulSoup, NavigableString, Comment, Tag, Doctype
 import bs4
 from termcolor import colored, cprint
 
 import cache
+import converter
+import fasttex
+import profiling
+import xhtml
 
 BOOK_SRC_DIR = 'information-retrieval'
 ONLINE_SRC_BASE = 'https://nlp.stanford.edu/IR-book/html/htmledition/'
 OUTPUT_DIR = 'output'
+MANIFEST_FILENAME = path.join(OUTPUT_DIR, '.manifest.json')
+ASSET_EXTENSIONS = ('.png', '.jpg')
+# Whether `build_chapter` returns its output for a `StagingArchive`
+# rather than writing it to `OUTPUT_DIR`
+STAGE_OUTPUT = False
+# Whether `build_chapter` keeps the images of formulas that fail to render,
+# and reports them in `ChapterResult.failures`, rather than failing
+KEEP_GOING = False
+# Whether pages are written as well-formed XHTML; see `xhtml.py`
+XHTML_OUTPUT = False
+# Where `epub.py` puts the book's stylesheet
+STYLESHEET_HREF = 'Styles/book.css'
 
 NAVPANEL_START = '<!--Navigation Panel-->'
 NAVPANEL_END  = '<!--End of Navigation Panel-->'
@@ -89,6 +117,18 @@ NEWCOMMANDS = {
     r'\begin{example}': r'\newenvironment{example}{}{}',
 }
 
+# What `Macros` looks for: environments, named as in `NEWCOMMANDS`, and
+# control sequences. Consuming whole control words means `\ne` never
+# matches inside `\neq`, and consuming control symbols means `\\ne` is a
+# line break followed by "ne".
+TEX_CONTROL = re.compile(r'\\begin\s*\{([a-zA-Z]+\*?)\}|\\(?:[a-zA-Z]+|.)', re.DOTALL)
+# The start of each definition in a preamble file
+TEX_DEFINITION = re.compile(r'''
+    \\(?:re)?newcommand\s*(?:\{\s*(?P<braced>\\[a-zA-Z]+)\s*\}|(?P<command>\\[a-zA-Z]+))
+  | \\(?:re)?newenvironment\s*\{(?P<environment>[a-zA-Z]+\*?)\}
+''', re.VERBOSE)
+TEX_COMMENT = re.compile(r'(?<!\\)%.*')
+
 
 ENV_START = re.compile(r'\\begin{[a-zA-Z]+\*?}')
 TEX_ONE_LETTER = re.compile(r'^\$([a-zA-Z])\$$')
@@ -109,10 +149,18 @@ def soup(fname: str) -> BeautifulSoup:
     return soups(read(fname))
 
 
-def delete_delimited_chunk(text: str, start: str, end: str) -> str:
-    inx = text.index(start)
-    end_idx = text.index(end, inx)
-    return text[:inx] + text[end_idx + len(end):]
+def delete_delimited_chunks(text: str, start: str, end: str) -> str:
+    pieces = []
+    pos = 0
+    while True:
+        inx = text.find(start, pos)
+        if inx == -1:
+            break
+        end_idx = text.index(end, inx)
+        pieces.append(text[pos:inx])
+        pos = end_idx + len(end)
+    pieces.append(text[pos:])
+    return ''.join(pieces)
 
 
 @dataclass
@@ -121,23 +169,155 @@ class TeXRenderError(BaseException):
     src: str
     context: Optional[BeautifulSoup] = None
 
+    def __reduce__(self):
+        # Neither pages nor CalledProcessErrors pickle, but their text is
+        # all we ever print
+        context = None if self.context is None else str(self.context)
+        return (_unpickle_tex_error, (
+            self.proc.returncode, self.proc.cmd, self.proc.output,
+            self.proc.stderr, self.src, context,
+        ))
+
+
+def _unpickle_tex_error(returncode, cmd, output, stderr, src, context):
+    return TeXRenderError(
+        proc=subprocess.CalledProcessError(
+            returncode=returncode,
+            cmd=cmd,
+            output=output,
+            stderr=stderr,
+        ),
+        src=src,
+        context=context,
+    )
+
 
-def tex_to_mathml_(tex: str) -> str:
-    prefix = []
+def tex_controls(tex: str) -> Set[str]:
+    """The control sequences and environments in `tex`, named as in `NEWCOMMANDS`."""
+    return {
+        r'\begin{' + m.group(1) + '}' if m.group(1) else m.group(0)
+        for m in TEX_CONTROL.finditer(tex)
+    }
 
-    for cmd, defn in NEWCOMMANDS.items():
-        if cmd in tex:
-            prefix.append(defn)
 
-    tex = ''.join(prefix) + tex
+class Macros:
+    """Definitions of the macros a book uses that SnuggleTeX doesn't know.
 
-    proc = subprocess.run(
-        ['snuggletex', '-'],
-        input=tex,
-        capture_output=True,
-        text=True,
-        encoding='utf-8',
+    `definitions` maps each macro, as `\name` or `\begin{name}`, to its
+    `\newcommand` or `\newenvironment`. Which macros a definition uses in
+    turn is worked out once, up front, so `preamble` finds everything a
+    formula needs in a single pass over it.
+    """
+
+    def __init__(self, definitions: Dict[str, str]):
+        self.definitions = definitions
+        uses = {
+            name: (tex_controls(defn) & definitions.keys()) - {name}
+            for name, defn in definitions.items()
+        }
+        self.closure: Dict[str, Set[str]] = {}
+        for name in definitions:
+            needed = {name}
+            pending = [name]
+            while pending:
+                for used in uses[pending.pop()] - needed:
+                    needed.add(used)
+                    pending.append(used)
+            self.closure[name] = needed
+
+    def preamble(self, tex: str) -> str:
+        """The definitions of every macro `tex` uses, in definition order."""
+        needed: Set[str] = set()
+        for name in tex_controls(tex) & self.definitions.keys():
+            needed |= self.closure[name]
+        return ''.join(defn for name, defn in self.definitions.items()
+                       if name in needed)
+
+
+def parse_preamble(text: str) -> Dict[str, str]:
+    """The definitions in a file of `\newcommand`s and `\newenvironment`s."""
+    text = TEX_COMMENT.sub('', text)
+    starts = list(TEX_DEFINITION.finditer(text))
+    definitions = {}
+    for m, end in zip(starts, [m.start() for m in starts[1:]] + [len(text)]):
+        if m.group('environment'):
+            name = r'\begin{' + m.group('environment') + '}'
+        else:
+            name = m.group('braced') or m.group('command')
+        definitions[name] = text[m.start():end].strip()
+    return definitions
+
+
+@functools.lru_cache()
+def load_macros(fname: Optional[str] = None) -> Macros:
+    """The macros defined in the preamble file `fname`, or `NEWCOMMANDS`."""
+    if fname is None:
+        return Macros(NEWCOMMANDS)
+    return Macros(parse_preamble(read(fname)))
+
+
+MACROS = load_macros()
+
+
+def tex_source(tex: str) -> str:
+    """`tex` with definitions for the book's macros it uses."""
+    return MACROS.preamble(tex) + tex
+
+
+def formula_key(src: str) -> str:
+    """The cache key for SnuggleTeX's output for `src`.
+
+    Both the converter version and the macro definitions `src` uses are part
+    of the key, so upgrading SnuggleTeX or editing a macro invalidates
+    exactly the entries that could have changed.
+    """
+    return converter.version() + '\n' + src
+
+
+# Prefixes the cache entries for formulas SnuggleTeX failed on, so that
+# reruns needn't try them again; MathML never starts with a NUL
+FAILURE_PREFIX = '\0failed\n'
+
+
+def render_tex(src: str) -> str:
+    return cache_entry(src, converter.run(src))
+
+
+def cache_entry(src: str, proc: subprocess.CompletedProcess) -> str:
+    """What to cache for the converter's output: MathML, or its failure."""
+    try:
+        return converted_mathml(src, proc)
+    except TeXRenderError as e:
+        return FAILURE_PREFIX + json.dumps({
+            'returncode': e.proc.returncode,
+            'cmd': e.proc.cmd,
+            'stdout': e.proc.output,
+            'stderr': e.proc.stderr,
+        })
+
+
+def is_failure(entry: str) -> bool:
+    return entry.startswith(FAILURE_PREFIX)
+
+
+def entry_mathml(src: str, entry: str) -> str:
+    """The MathML in a cache entry, or the `TeXRenderError` it records."""
+    if not is_failure(entry):
+        return entry
+    failure = json.loads(entry[len(FAILURE_PREFIX):])
+    raise TeXRenderError(
+        proc=subprocess.CalledProcessError(
+            returncode=failure['returncode'],
+            cmd=failure['cmd'],
+            output=failure['stdout'],
+            stderr=failure['stderr'],
+        ),
+        src=src,
     )
+
+
+def converted_mathml(src: str, proc: subprocess.CompletedProcess) -> str:
+    """The converter's output, if it ran cleanly."""
     if proc.returncode != 0 or proc.stderr.strip():
         raise TeXRenderError(
             proc=subprocess.CalledProcessError(
@@ -146,16 +326,67 @@ def tex_to_mathml_(tex: str) -> str:
                 output=proc.stdout,
                 stderr=proc.stderr,
             ),
-            src=tex,
+            src=src,
         )
+    return proc.stdout
+
 
+def postprocess_mathml(mathml: str) -> str:
     # Patch up \lfloor and \rfloor
-    return (proc.stdout.replace(LEFT_FLOOR_MATHML, LEFT_FLOOR_ACTUAL)
+    return (mathml.replace(LEFT_FLOOR_MATHML, LEFT_FLOOR_ACTUAL)
             .replace(RIGHT_FLOOR_MATHML, RIGHT_FLOOR_ACTUAL)
     )
 
 
-def tex_to_mathml(tex: str) -> str:
+def fast_tex_to_mathml(tex: str) -> Optional[str]:
+    # The book's macros may redefine what fasttex thinks it knows
+    if not fasttex.enabled() or MACROS.preamble(tex):
+        return None
+    return fasttex.render(tex)
+
+
+# Formulas whose fasttex output has been reported as wrong, so that each is
+# reported once however often it's used; workers inherit the prerender's
+_fasttex_mismatches: Set[str] = set()
+
+
+def check_fasttex(tex: str, fast: str, mathml: str) -> bool:
+    """Whether fasttex got `tex` right, reporting it the first time it didn't."""
+    if fast == mathml:
+        return True
+    if tex not in _fasttex_mismatches:
+        _fasttex_mismatches.add(tex)
+        report_fasttex_mismatch(tex, fast, mathml)
+    return False
+
+
+def report_fasttex_mismatch(tex: str, fast: str, mathml: str):
+    cprint('Fast TeX renderer disagrees with SnuggleTeX for:', 'yellow', attrs=['bold'])
+    print(tex)
+    print('fasttex:   ', fast)
+    print('SnuggleTeX:', mathml)
+
+
+def tex_to_mathml_(tex: str) -> str:
+    fast = fast_tex_to_mathml(tex)
+    if fast is not None and not fasttex.verifying():
+        with profiling.formula(tex):
+            return fast
+
+    # The cache holds SnuggleTeX's own output, so changes to the
+    # post-processing never need to invalidate it
+    src = tex_source(tex)
+    with profiling.formula(tex) as timer:
+        def render(key):
+            with timer.converting():
+                return render_tex(src)
+        mathml = entry_mathml(src, cache.ensure(formula_key(src), render))
+    if fast is not None:
+        check_fasttex(tex, fast, mathml)
+    return postprocess_mathml(mathml)
+
+
+def normalize_tex(tex: str) -> str:
     display_start = r'$\displaystyle'
     display_end = '$'
     if tex.startswith(display_start) and tex.endswith(display_end):
@@ -183,7 +414,11 @@ def tex_to_mathml(tex: str) -> str:
            .replace(r'\big)', r'\right)')
            .replace(r'\nolimits', ''))
 
-    return cache.ensure(tex, tex_to_mathml_)
+    return tex
+
+
+def tex_to_mathml(tex: str) -> str:
+    return tex_to_mathml_(normalize_tex(tex))
 
 
 def trivial_tex_to_mathml(tex: str) -> Optional[str]:
@@ -245,105 +480,400 @@ def expand_ellipsized(el: Tag) -> Optional[str]:
     return tex
 
 
-def process_chapter(chapter: str) -> BeautifulSoup:
+def image_tex(img: Tag) -> Optional[str]:
+    """The TeX an image was rendered from, or `None` if it isn't math."""
+    alt = img['alt']
+    if '...' in alt:
+        # they literally deleted half the source i'd need to correctly
+        # reproduce the larger figures...
+        alt = expand_ellipsized(img)
+        if alt is None:
+            return None
+    if alt.endswith('.html'):
+        # wtf are you doing
+        return None
+    if r'\includegraphics' in alt:
+        return None
+    return alt
+
+
+def trim_chapter(chapter: str) -> str:
     # Trim navpanels
-    while NAVPANEL_START in chapter:
-        chapter = delete_delimited_chunk(chapter, NAVPANEL_START, NAVPANEL_END)
+    chapter = delete_delimited_chunks(chapter, NAVPANEL_START, NAVPANEL_END)
 
     # We want to remove the sub-chapter links unless it's the intro page
     if IRBOOK_MARKER not in chapter:
-        while CHILD_LINKS_START in chapter:
-            chapter = delete_delimited_chunk(chapter, CHILD_LINKS_START, CHILD_LINKS_END)
+        chapter = delete_delimited_chunks(chapter, CHILD_LINKS_START, CHILD_LINKS_END)
 
-    chapter_soup = soups(chapter)
+    return chapter
 
-    # Delete elements that epub doesn't like
-    for el in chapter_soup.find_all('meta'):
-        el.decompose()
 
-    # Delete the "autogenerated page" footer
-    address = chapter_soup.find('address')
-    if address:
-        address.decompose()
-
-    # The link 404's anyways
-    css_link = chapter_soup.find('link', href='https://nlp.stanford.edu/IR-book/html/htmledition/irbook.css')
-    if css_link:
-        css_link.decompose()
-
-    # Who puts a <br> in a header??!
-    h1 = chapter_soup.find('h1')
-    if h1:
-        br = h1.find('br')
-        if br:
-            br.decompose()
-
-    for s in chapter_soup.find_all(text=re.compile("[`']")):
-        if type(s) in [Comment, bs4.Doctype, bs4.ProcessingInstruction, bs4.Declaration]:
-            continue
-        old_s = str(s)
-        new_s = (
-            old_s
-            .replace('``', '“')
-            .replace("''", '”')
-            .replace("'", '’')
-            .replace("`", '‘')
-        )
-        s.replace_with(new_s)
-
-    for img in chapter_soup.find_all('img'):
-        alt = img['alt']
-        if '...' in alt:
-            # they literally deleted half the source i'd need to correctly
-            # reproduce the larger figures...
-            alt = expand_ellipsized(img)
-            if alt is None:
-                continue
-        if alt.endswith('.html'):
-            # wtf are you doing
-            continue
-        if r'\includegraphics' in alt:
+def chapter_formulas(chapter_filename: str) -> List[str]:
+    """The normalized TeX of every formula `process_chapter` would render."""
+    chapter_soup = soups(trim_chapter(decode(read_source(chapter_filename))))
+    formulas = []
+    # The same walk, so it skips whatever the rewrite deletes before reaching
+    ChapterRewriter(formulas, render=False).rewrite(chapter_soup)
+    return formulas
+
+
+def chapter_sources(chapter_filename: str) -> List[Tuple[str, str]]:
+    """The chapter's formulas SnuggleTeX will be asked to render.
+
+    Each comes with its `tex_source`, under the macros of the book that's
+    active now. Those fasttex renders are left out, unless it's verifying.
+    """
+    return [
+        (tex, tex_source(tex)) for tex in chapter_formulas(chapter_filename)
+        if fasttex.verifying() or fast_tex_to_mathml(tex) is None
+    ]
+
+
+# A chapter to build, and what activates the settings of its book
+Task = Tuple[Callable[[], None], str]
+
+
+def activate_nothing():
+    """For chapters of the book this module's own settings describe."""
+
+
+def task_sources(task: Task) -> List[Tuple[str, str]]:
+    activate, chapter_filename = task
+    activate()
+    return chapter_sources(chapter_filename)
+
+
+def build_task(task: Task) -> 'ChapterResult':
+    activate, chapter_filename = task
+    activate()
+    return build_chapter(chapter_filename)
+
+
+def prerender_source(src: str) -> bool:
+    with profiling.formula(src) as timer:
+        def render(key):
+            with timer.converting():
+                return render_tex(src)
+        entry = cache.ensure(formula_key(src), render)
+    return not is_failure(entry)
+
+
+def prerender(tasks: List[Task], jobs: int, converters: int):
+    """Render every formula in `tasks`' chapters into the cache up front.
+
+    A book reuses the same handful of formulas thousands of times, so we
+    dedupe across every chapter and convert only the misses, `converters`
+    at a time. Each formula's source is worked out under its own book, so
+    books with different macros can be rendered together. Failures are
+    cached too; the rewrite stage finds them there and reports them with
+    their page context.
+    """
+    if jobs > 1 and len(tasks) > 1:
+        with multiprocessing.Pool(min(jobs, len(tasks))) as pool:
+            per_chapter = pool.map(task_sources, tasks)
+    else:
+        per_chapter = map(task_sources, tasks)
+    formulas = list(dict.fromkeys(itertools.chain.from_iterable(per_chapter)))
+    render_sources([src for _, src in formulas], converters)
+    if fasttex.verifying():
+        verify_fasttex(formulas)
+
+
+def render_sources(sources: Iterable[str], converters: int):
+    """Convert the distinct, uncached `tex_source`s, `converters` at a time."""
+    # The cache key depends on nothing else, so this dedupes on it too
+    sources = list(dict.fromkeys(sources))
+    misses = [src for src in sources if cache.read(formula_key(src)) is None]
+    if not misses:
+        return
+
+    cprint(f'Rendering {len(misses)} of {len(sources)} distinct formulas',
+           'green', attrs=['bold'])
+    with concurrent.futures.ThreadPoolExecutor(converters) as executor:
+        failed = list(executor.map(prerender_source, misses)).count(False)
+    if failed:
+        cprint(f'{failed} formulas failed to render', 'yellow', attrs=['bold'])
+
+
+def verify_fasttex(formulas: Iterable[Tuple[str, str]]):
+    """Compare fasttex with SnuggleTeX's cached output for each of `formulas`.
+
+    They're `chapter_sources`, so only those without a preamble are
+    fasttex's to render.
+    """
+    checked = wrong = 0
+    for tex, src in formulas:
+        fast = fasttex.render(tex) if src == tex else None
+        entry = cache.read(formula_key(src))
+        if fast is None or entry is None or is_failure(entry):
             continue
+        checked += 1
+        if not check_fasttex(tex, fast, entry):
+            wrong += 1
+    color = 'yellow' if wrong else 'green'
+    cprint(f'fasttex matched SnuggleTeX on {checked - wrong} of {checked} '
+           'distinct formulas', color, attrs=['bold'])
+
+
+QUOTE_CHARS = re.compile("[`']")
+UNQUOTED_TYPES = [Comment, bs4.Doctype, bs4.ProcessingInstruction, bs4.Declaration]
+IRBOOK_CSS = 'https://nlp.stanford.edu/IR-book/html/htmledition/irbook.css'
+
+
+def next_after(el: bs4.PageElement) -> Optional[bs4.PageElement]:
+    """The first element after `el` and all its descendants."""
+    while el is not None:
+        if el.next_sibling is not None:
+            return el.next_sibling
+        el = el.parent
+    return None
+
+
+def last_tag(el: Tag) -> Optional[Tag]:
+    """The last tag inside `el`, in document order."""
+    last = None
+    while True:
+        for child in reversed(el.contents):
+            if isinstance(child, Tag):
+                last = el = child
+                break
+        else:
+            return last
+
+
+def normalize_attrs(el: Tag):
+    """Get rid of naughty attributes."""
+    el['class'] = ''
+    for attr in ['align', 'valign', 'cellpadding', 'border', 'nowrap', 'compact']:
+        if el.has_attr(attr):
+            el['class'] += attr + '-' + el[attr].lower()
+            del el[attr]
+
+    if el.has_attr('width'):
+        if el['width'] == '100%':
+            el['class'] += ' full-width'
+        else:
+            el['class'] += ' width-' + el['width']
+        del el['width']
+
+    if not el['class']:
+        del el['class']
+
+
+def clean_tag(el: Tag):
+    """Rules for every tag that ends up on the page, inserted or not."""
+    normalize_attrs(el)
+
+    if el.name == 'br' and el.has_attr('clear'):
+        del el['clear']
+    elif el.name == 'tt':
+        el.name = 'code'
+
+
+class SplicedMathML(xhtml.RawMarkup):
+    """A formula's MathML, already cleaned up and serialized for the page."""
+
+
+def is_spliced_mathml(s) -> bool:
+    return isinstance(s, SplicedMathML)
+
+
+def mathml_markup(mathml: str, xhtml_output: bool) -> str:
+    """`mathml` as it should appear on the page, parsed once per run.
+
+    The same formula tends to turn up many times, and parsing each copy into
+    tags only for them to be written straight back out is most of what
+    splicing it in used to cost. Up to `--memo-size` are kept.
+    """
+    memo = cache.derived_memo('markup memo')
+    key = (mathml, xhtml_output)
+    markup = memo.get(key)
+    if markup is None:
+        markup = parse_mathml_markup(mathml, xhtml_output)
+        memo.put(key, markup)
+    return markup
+
+
+def parse_mathml_markup(mathml: str, xhtml_output: bool) -> str:
+    with profiling.stage('parse mathml'):
+        fragment = soups(mathml, 'html.parser')
+    for el in fragment.find_all(True):
+        clean_tag(el)
+    out = io.StringIO()
+    xhtml.write(fragment, out, xhtml=xhtml_output)
+    return out.getvalue()
+
+
+def curly_quotes(s: str) -> str:
+    return (
+        s
+        .replace('``', '“')
+        .replace("''", '”')
+        .replace("'", '’')
+        .replace("`", '‘')
+    )
+
+
+class ChapterRewriter:
+    """The transforms `process_chapter` applies, in one walk over the page.
+
+    Elements are visited in document order. A tag rule that removes or
+    replaces its tag returns the element the walk should resume from (which
+    is `None` at the end of the page); otherwise it returns `False` and the
+    tag is cleaned up and descended into like any other.
+
+    Without `render`, the walk only collects `formulas`: it deletes what it
+    would have, but leaves formulas as images and the rest of the page as
+    it was.
+    """
+
+    def __init__(self, formulas: Optional[List[str]] = None,
+                 failures: Optional[List[TeXRenderError]] = None,
+                 render: bool = True):
+        self.formulas = formulas
+        self.failures = failures
+        self.render = render
+        self.seen_address = False
+        self.seen_css_link = False
+        self.seen_h1 = False
+        self.fixed_bad_a = False
+        self.tag_rules = {
+            'meta': self.delete,
+            'address': self.address,
+            'link': self.link,
+            'h1': self.h1,
+            'img': self.img,
+        }
+
+    def rewrite(self, chapter_soup: BeautifulSoup):
+        el = chapter_soup.contents[0] if chapter_soup.contents else None
+        while el is not None:
+            if isinstance(el, Tag):
+                rule = self.tag_rules.get(el.name)
+                resume = rule(el) if rule else False
+                if resume is not False:
+                    el = resume
+                    continue
+                if self.render:
+                    self.clean_tag(el)
+            elif (self.render and QUOTE_CHARS.search(el)
+                    and type(el) not in UNQUOTED_TYPES):
+                new_el = NavigableString(curly_quotes(str(el)))
+                el.replace_with(new_el)
+                el = new_el
+            el = el.next_element
+
+        if self.render:
+            self.trim_trailing_tags(chapter_soup.body)
+
+    def clean_tag(self, el: Tag):
+        # this prevents a file from being invalid xhtml lol
+        if (el.name == 'a' and not self.fixed_bad_a
+                and el.has_attr('wikipedia:general')):
+            del el['wikipedia:general']
+            self.fixed_bad_a = True
+        clean_tag(el)
+
+    def delete(self, el: Tag):
+        # Delete elements that epub doesn't like
+        resume = next_after(el)
+        el.decompose()
+        return resume
+
+    def address(self, el: Tag):
+        # Delete the "autogenerated page" footer
+        if self.seen_address:
+            return False
+        self.seen_address = True
+        return self.delete(el)
+
+    def link(self, el: Tag):
+        # The link 404's anyways
+        if self.seen_css_link or el.get('href') != IRBOOK_CSS:
+            return False
+        self.seen_css_link = True
+        return self.delete(el)
+
+    def h1(self, el: Tag):
+        # Who puts a <br> in a header??!
+        if not self.seen_h1:
+            self.seen_h1 = True
+            br = el.find('br')
+            if br:
+                br.decompose()
+        return False
+
+    def img(self, img: Tag):
+        alt = image_tex(img)
+        if alt is None:
+            return False
 
         # cross-reference symbol
         if alt == '[*]':
-            img.parent.string = '‡'
-            continue
+            parent = img.parent
+            parent.string = '‡'
+            return next_after(parent)
 
         mathml = trivial_tex_to_mathml(alt)
         if mathml is None:
             # Otherwise, give SnuggleTeX a try:
+            tex = normalize_tex(alt)
+            if self.formulas is not None:
+                self.formulas.append(tex)
+            if not self.render:
+                return False
             try:
-                mathml = tex_to_mathml(alt)
+                mathml = tex_to_mathml_(tex)
             except TeXRenderError as e:
                 e.context = img.parent
-                raise
-
-        img.replace_with(soups(mathml, 'html.parser'))
-
-    # delete empty children at the end of the docment
-    annoying_tag_names = ['hr', 'p', 'br']
-    empty_tags = ['hr', 'br']
-    children = list(chapter_soup.body.find_all(True))
-    if children:
-        for last_child in reversed(children):
-            if last_child.name in annoying_tag_names:
-                if last_child.name in empty_tags:
-                    last_child.decompose()
-                    continue
-
-                if last_child.string and last_child.string.strip():
-                    break
-                else:
-                    last_child.decompose()
-            else:
+                if self.failures is None:
+                    raise
+                # Leave LaTeX2HTML's picture of the formula in its place
+                self.failures.append(e)
+                return False
+
+        resume = next_after(img)
+        # A new string each time: a node can only be in one place at once
+        img.replace_with(SplicedMathML(mathml_markup(mathml, XHTML_OUTPUT)))
+        return resume
+
+    def trim_trailing_tags(self, body: Tag):
+        """Delete empty children at the end of the document."""
+        annoying_tag_names = ['hr', 'p', 'br']
+        empty_tags = ['hr', 'br']
+        last_child = last_tag(body)
+        while last_child is not None and last_child is not body:
+            if last_child.name not in annoying_tag_names:
                 break
-
-    # this prevents a file from being invalid xhtml lol
-    for bad_a in chapter_soup.find_all('a'):
-        if bad_a.has_attr('wikipedia:general'):
-            del bad_a['wikipedia:general']
-            break
+            # Formulas aren't tags, but they aren't empty either
+            if last_child.find_next(string=is_spliced_mathml) is not None:
+                break
+            prev = last_child.find_previous(True)
+            if last_child.name in empty_tags:
+                last_child.decompose()
+            elif last_child.string and last_child.string.strip():
+                break
+            else:
+                last_child.decompose()
+            last_child = prev
+
+
+def process_chapter(chapter: str,
+                    formulas: Optional[List[str]] = None,
+                    failures: Optional[List[TeXRenderError]] = None) -> BeautifulSoup:
+    """Clean up one page of LaTeX2HTML output.
+
+    If `formulas` is given, the normalized TeX of every formula rendered
+    with SnuggleTeX is appended to it. If `failures` is given, formulas
+    SnuggleTeX can't render are appended to it and left as images, rather
+    than raised.
+    """
+    with profiling.stage('trim'):
+        chapter = trim_chapter(chapter)
+    with profiling.stage('parse'):
+        chapter_soup = soups(chapter)
+    with profiling.stage('rewrite'):
+        ChapterRewriter(formulas, failures).rewrite(chapter_soup)
 
     # # We're renaming everything to .xhtml
     # for el in itertools.chain(chapter_soup.find_all('link'),
@@ -351,31 +881,6 @@ def process_chapter(chapter: str) -> BeautifulSoup:
     #     if el.has_attr('href') and not el['href'].startswith('http'):
     #         el['href'] = el['href'].replace('.html', '.xhtml')
 
-    # Get rid of naughty attributes
-    for el in chapter_soup.find_all(True):
-        el['class'] = ''
-        for attr in ['align', 'valign', 'cellpadding', 'border', 'nowrap', 'compact']:
-            if el.has_attr(attr):
-                el['class'] += attr + '-' + el[attr].lower()
-                del el[attr]
-
-        if el.has_attr('width'):
-            if el['width'] == '100%':
-                el['class'] += ' full-width'
-            else:
-                el['class'] += ' width-' + el['width']
-            del el['width']
-
-        if not el['class']:
-            del el['class']
-
-    for el in chapter_soup.find_all('br'):
-        if el.has_attr('clear'):
-            del el['clear']
-
-    for el in chapter_soup.find_all('tt'):
-        el.name = 'code'
-
     chapter_soup.html.head.append(
         chapter_soup.new_tag('meta', charset='utf-8')
     )
@@ -384,7 +889,7 @@ def process_chapter(chapter: str) -> BeautifulSoup:
             'link',
             rel='stylesheet',
             type='text/css',
-            href='Styles/book.css',
+            href=STYLESHEET_HREF,
         )
     )
 
@@ -405,6 +910,64 @@ def process_chapter(chapter: str) -> BeautifulSoup:
     return chapter_soup
 
 
+def toc_outline(ul: Tag) -> List[dict]:
+    return [
+        {
+            'href': li.a['href'],
+            'title': str(li.a.string),
+            'children': toc_outline(li.ul) if li.ul else [],
+        }
+        for li in ul.find_all('li', recursive=False)
+        if li.a is not None and li.a.has_attr('href')
+    ]
+
+
+def chapter_metadata(chapter_soup: BeautifulSoup) -> dict:
+    """What `epub.py` needs to know about a page, so it needn't parse it.
+
+    `toc` outlines the page's first list of links; for the contents page,
+    that's the book's table of contents.
+    """
+    title = None
+    mathml = False
+    images = set()
+    links = set()
+    toc = None
+    for el in chapter_soup.find_all(['title', 'math', 'img', 'a', 'ul']):
+        if el.name == 'title' and title is None:
+            title = str(el.string)
+        elif el.name == 'math':
+            mathml = True
+        elif el.name == 'img' and el.has_attr('src'):
+            images.add(el['src'])
+        elif el.name == 'a' and el.has_attr('href'):
+            links.add(el['href'])
+        elif el.name == 'ul' and toc is None:
+            toc = toc_outline(el)
+    if not mathml:
+        mathml = chapter_soup.find(string=is_spliced_mathml) is not None
+    return {
+        'title': title,
+        'mathml': mathml,
+        'images': sorted(images),
+        'links': sorted(links),
+        'toc': toc,
+    }
+
+
+def metadata_filename(output_filename: str) -> str:
+    return path.splitext(output_filename)[0] + '.meta.json'
+
+
+def load_metadata(output_filename: str) -> dict:
+    """The sidecar written with an output page, or failing that, the page."""
+    try:
+        with open(metadata_filename(output_filename), encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return chapter_metadata(soup(output_filename))
+
+
 
 def output_files(ext: Optional[str] = None) -> List[str]:
     return [
@@ -414,57 +977,695 @@ def output_files(ext: Optional[str] = None) -> List[str]:
     ]
 
 
-def main():
+def report_tex_error(e: TeXRenderError, output_basename: str):
+    cprint('Error while converting TeX to MathML', 'red', attrs=['bold'])
+    print(e.proc)
+    print(e.proc.output.strip())
+    cprint(e.proc.stderr.strip(), 'red')
+    cprint('TeX source:', 'red', attrs=['bold'])
+    print(e.src)
+    if e.context:
+        cprint('Page context:', 'red', attrs=['bold'])
+        print(e.context)
+    print('Check the chapter online:', colored(
+        ONLINE_SRC_BASE + output_basename,
+        'cyan', attrs=['underline']
+    ))
+
+
+def tex_error_record(e: TeXRenderError, output_basename: str) -> dict:
+    """`report_tex_error`'s details, for the `--keep-going` report."""
+    return {
+        'chapter': output_basename,
+        'url': ONLINE_SRC_BASE + output_basename,
+        'source': e.src,
+        'returncode': e.proc.returncode,
+        'stdout': e.proc.output,
+        'stderr': e.proc.stderr,
+        'context': None if e.context is None else str(e.context),
+    }
+
+
+def write_error_report(fname: str, failures: List[dict]):
+    write_atomic(fname, json.dumps(failures, indent=2, ensure_ascii=False) + '\n')
+    if failures:
+        chapters = len({failure['chapter'] for failure in failures})
+        cprint(f'{len(failures)} formulas in {chapters} chapters failed to '
+               f'render; see {fname}', 'red', attrs=['bold'])
+
+
+def file_hash(fname: str) -> str:
+    with open(fname, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def decode(raw: bytes) -> str:
+    """`raw` as `read` would have read it, newline translation and all."""
+    return io.TextIOWrapper(io.BytesIO(raw), encoding='utf-8').read()
+
+
+def read_hashed(fname: str) -> Tuple[str, str]:
+    """A source page's text, and a hash of its bytes."""
+    raw = read_source(fname)
+    return decode(raw), hashlib.sha256(raw).hexdigest()
+
+
+# Reading the umask means setting it, so do it once, before any threads
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+
+def mkstemp_beside(fname: str) -> Tuple[int, str]:
+    """A temporary file to replace `fname` with, and its descriptor.
+
+    It has the permissions `open` would have given `fname`, rather than
+    `mkstemp`'s private 0600, since `os.replace` keeps them.
+    """
+    fd, tmp = tempfile.mkstemp(
+        dir=path.dirname(fname) or '.',
+        prefix='.' + path.basename(fname) + '.',
+        suffix='.tmp',
+    )
+    os.fchmod(fd, 0o666 & ~UMASK)
+    return fd, tmp
+
+
+@contextlib.contextmanager
+def open_atomic(fname: str) -> Iterator[TextIO]:
+    """Open `fname` for writing so readers only ever see the old or the new contents."""
+    fd, tmp = mkstemp_beside(fname)
+    try:
+        with open(fd, 'w', encoding='utf-8') as f:
+            yield f
+        os.replace(tmp, fname)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+def write_atomic(fname: str, text: str):
+    with open_atomic(fname) as f:
+        f.write(text)
+
+
+@functools.lru_cache()
+def code_version() -> str:
+    return file_hash(__file__) + file_hash(fasttex.__file__) + file_hash(xhtml.__file__)
+
+
+def settings_version() -> str:
+    """A hash of the active book's settings that pages are built under.
+
+    The macros aren't among them: they're part of each formula's key.
+    """
+    settings = [IRBOOK_MARKER, IRBOOK_CSS, STYLESHEET_HREF, OUTPUT_DIR]
+    return hashlib.sha256(json.dumps(settings).encode('utf-8')).hexdigest()[:16]
+
+
+def pipeline_version() -> str:
+    """Changes whenever the code that transforms a page, or how, might have."""
+    version = code_version() + '-' + settings_version()
+    # When verifying, the pages get SnuggleTeX's output all the same
+    if fasttex.enabled() and not fasttex.verifying():
+        version += '-fasttex'
+    if XHTML_OUTPUT:
+        version += '-xhtml'
+    return version
+
+
+def formulas_hash(formulas: List[str]) -> str:
+    keys = '\0'.join(formula_key(tex_source(tex)) for tex in formulas)
+    return hashlib.sha256(keys.encode('utf-8')).hexdigest()
+
+
+def parse_manifest(text: str) -> dict:
+    try:
+        manifest = json.loads(text)
+    except json.JSONDecodeError:
+        return {}
+    if manifest.get('pipeline') != pipeline_version():
+        return {}
+    return manifest.get('chapters', {})
+
+
+def format_manifest(chapters: dict) -> str:
+    return json.dumps({
+        'pipeline': pipeline_version(),
+        'chapters': chapters,
+    })
+
+
+def load_manifest() -> dict:
+    try:
+        return parse_manifest(read(MANIFEST_FILENAME))
+    except FileNotFoundError:
+        return {}
+
+
+def save_manifest(chapters: dict):
+    write_atomic(MANIFEST_FILENAME, format_manifest(chapters))
+
+
+def is_up_to_date(chapter_filename: str, entry: Optional[dict],
+                  output_exists: Callable[[str], bool] = path.exists) -> bool:
+    """Whether the output for a chapter was built from the same inputs.
+
+    Those are the source page, this pipeline, and the cache keys of every
+    formula on the page, which cover the converter version and macros.
+    """
+    output_filename = path.join(OUTPUT_DIR, path.basename(chapter_filename))
+    return (entry is not None
+            and output_exists(output_filename)
+            and output_exists(metadata_filename(output_filename))
+            and entry['source'] == hashlib.sha256(read_source(chapter_filename)).hexdigest()
+            and entry['formulas'] == formulas_hash(entry['tex']))
+
+
+@functools.lru_cache()
+def load_archive(archive: str) -> Dict[str, bytes]:
+    """The pages and images in a tarball of LaTeX2HTML output.
+
+    Read in one pass, straight from the (possibly compressed) stream, without
+    extracting anything to disk. Workers forked afterwards inherit it.
+    """
+    files = {}
+    with tarfile.open(archive, 'r:*') as tar:
+        for member in tar:
+            if member.isfile() and member.name.endswith(('.html',) + ASSET_EXTENSIONS):
+                files[member.name] = tar.extractfile(member).read()
+    return files
+
+
+def source_archive() -> Optional[Dict[str, bytes]]:
+    """The contents of `BOOK_SRC_DIR`, if it names an archive."""
+    if path.isfile(BOOK_SRC_DIR):
+        return load_archive(path.realpath(BOOK_SRC_DIR))
+    return None
+
+
+def source_files(ext: Union[str, Tuple[str, ...]]) -> List[str]:
+    archive = source_archive()
+    if archive is not None:
+        return sorted(name for name in archive if name.endswith(ext))
     src_dir = path.realpath(BOOK_SRC_DIR)
-    chapters = [
+    return [
         path.join(src_dir, p)
         for p in sorted(os.listdir(src_dir))
-        if p.endswith('.html')
+        if p.endswith(ext)
     ]
-    skipping = True
-    skip_until = None
-
-    digits = math.ceil(math.log10(len(chapters)))
-    fmt = f'{digits}d'
-
-    if not path.exists(OUTPUT_DIR):
-        os.mkdir(OUTPUT_DIR)
-    cache.init_cache()
-
-    for i, chapter_filename in enumerate(chapters):
-        i += 1
-        if skip_until is None or chapter_filename.endswith(skip_until):
-            skipping = False
-        output_basename = path.basename(chapter_filename)
-        output_filename = path.join(OUTPUT_DIR, output_basename)
-        print(colored(
-            '[{}/{}]:'.format(format(i, fmt), len(chapters)),
-            'green', attrs=['bold']),
-              output_basename)
-        if skipping:
-            continue
-        with open(output_filename, 'w') as f:
-            chapter_txt = read(chapter_filename)
+
+
+def source_chapters() -> List[str]:
+    return source_files('.html')
+
+
+def read_source(fname: str) -> bytes:
+    """One of the `source_files`, from the archive or the directory."""
+    archive = source_archive()
+    if archive is not None:
+        return archive[fname]
+    with open(fname, 'rb') as f:
+        return f.read()
+
+
+def stale_chapters(chapters: List[str], manifest: dict,
+                   output_exists: Callable[[str], bool] = path.exists) -> List[str]:
+    """The `chapters` whose output isn't up to date according to `manifest`."""
+    return [
+        chapter_filename for chapter_filename in chapters
+        if not is_up_to_date(chapter_filename,
+                             manifest.get(path.basename(chapter_filename)),
+                             output_exists)
+    ]
+
+
+class StagingArchive:
+    """A zip of the build's output, for `epub.py --staging`, instead of `OUTPUT_DIR`.
+
+    Every build writes a fresh archive beside the old one and replaces it
+    on `close`. Up-to-date pages are carried over from the old archive, which
+    also holds the manifest for incremental builds. A build that stops early
+    carries over the rest of the old archive too, so like `OUTPUT_DIR`, it's
+    left with the previous version of every page it didn't get to.
+    """
+
+    def __init__(self, fname: str):
+        self.fname = fname
+        self.previous = None
+        self.previous_names = set()
+        if path.exists(fname):
+            self.previous = zipfile.ZipFile(fname)
+            self.previous_names = set(self.previous.namelist())
+        fd, self.tmp = mkstemp_beside(fname)
+        os.close(fd)
+        self.out = zipfile.ZipFile(self.tmp, 'w', zipfile.ZIP_DEFLATED)
+        self.written: Set[str] = set()
+
+    def has(self, name: str) -> bool:
+        return path.basename(name) in self.previous_names
+
+    def load_manifest(self) -> dict:
+        name = path.basename(MANIFEST_FILENAME)
+        if not self.has(name):
+            return {}
+        return parse_manifest(self.previous.read(name).decode('utf-8'))
+
+    def write(self, name: str, data: Union[str, bytes]):
+        compress_type = None
+        if name.endswith(ASSET_EXTENSIONS):
+            compress_type = zipfile.ZIP_STORED
+        self.out.writestr(name, data, compress_type=compress_type)
+        self.written.add(name)
+
+    def keep(self, name: str):
+        """Carry `name` over from the previous archive."""
+        self.write(name, self.previous.read(name))
+
+    def close(self, chapters: dict, complete: bool = True):
+        """Replace the old archive, listing `chapters` in its manifest.
+
+        Unless the build is `complete`, whatever it didn't write is carried
+        over from the old archive, but left out of the manifest so that the
+        next build tries it again.
+        """
+        if not complete and self.previous is not None:
+            manifest_name = path.basename(MANIFEST_FILENAME)
+            for name in self.previous.namelist():
+                if name not in self.written and name != manifest_name:
+                    self.keep(name)
+        self.write(path.basename(MANIFEST_FILENAME), format_manifest(chapters))
+        self.out.close()
+        if self.previous is not None:
+            self.previous.close()
+        os.replace(self.tmp, self.fname)
+
+
+@dataclass
+class ChapterResult:
+    error: Optional[TeXRenderError] = None
+    manifest_entry: Optional[dict] = None
+    profile: Optional[profiling.Profile] = None
+    # With `STAGE_OUTPUT`, the files to stage, by name
+    files: Optional[Dict[str, str]] = None
+    # With `KEEP_GOING`, a `tex_error_record` for each formula left as an image
+    failures: List[dict] = field(default_factory=list)
+
+
+def build_chapter(chapter_filename: str) -> ChapterResult:
+    """Process one source file into `OUTPUT_DIR`.
+
+    Errors are returned rather than raised so they can cross process
+    boundaries; `TeXRenderError` is a `BaseException`, which
+    `multiprocessing` won't catch for us.
+    """
+    output_filename = path.join(OUTPUT_DIR, path.basename(chapter_filename))
+    profiling.begin_chapter(path.basename(chapter_filename))
+    with profiling.stage('read'):
+        chapter_txt, source_hash = read_hashed(chapter_filename)
+    formulas = []
+    failures = [] if KEEP_GOING else None
+    try:
+        chapter_soup = process_chapter(chapter_txt, formulas, failures)
+    except TeXRenderError as e:
+        profiling.end_chapter()
+        cache.flush()
+        return ChapterResult(error=e)
+
+    with profiling.stage('metadata'):
+        metadata = json.dumps(chapter_metadata(chapter_soup))
+    files = None
+    if STAGE_OUTPUT:
+        with profiling.stage('serialize'):
+            output = io.StringIO()
+            xhtml.write(chapter_soup, output, xhtml=XHTML_OUTPUT)
+        files = {
+            path.basename(output_filename): output.getvalue(),
+            path.basename(metadata_filename(output_filename)): metadata,
+        }
+    else:
+        # Serialized straight into the file
+        with profiling.stage('write'):
+            with open_atomic(output_filename) as f:
+                xhtml.write(chapter_soup, f, xhtml=XHTML_OUTPUT)
+            write_atomic(metadata_filename(output_filename), metadata)
+    # Workers are terminated rather than left to exit, which would lose
+    # the uses of the cache they haven't written yet
+    cache.flush()
+    return ChapterResult(
+        manifest_entry={
+            'source': source_hash,
+            'formulas': formulas_hash(formulas),
+            'tex': formulas,
+        },
+        profile=profiling.end_chapter(),
+        files=files,
+        failures=[tex_error_record(e, path.basename(chapter_filename))
+                  for e in failures or []],
+    )
+
+
+class AsyncPipeline:
+    """Builds chapters while converting the formulas of the ones after them.
+
+    Each task's formulas are found and converted, `converters` at a time
+    as asyncio subprocesses, before the chapter itself is built in
+    `executor` from the then-warm cache. At most `in_flight` chapters are
+    underway at once, so a slow converter stalls the pipeline rather than
+    letting parsed chapters pile up in memory.
+    """
+
+    def __init__(self, executor: concurrent.futures.Executor,
+                 converters: int, in_flight: int):
+        self.executor = executor
+        self.converting = asyncio.Semaphore(converters)
+        self.in_flight = in_flight
+        # Formulas being converted for another chapter, until they're done
+        # and in the cache
+        self.rendering: Dict[str, asyncio.Future] = {}
+
+    async def render(self, src: str):
+        key = formula_key(src)
+        if cache.read(key) is not None:
+            return
+        async with self.converting:
+            with profiling.formula(src) as timer, timer.converting():
+                proc = await converter.run_async(src)
+        # Failures too; building the chapter reports them with their
+        # page context
+        cache.write(key, cache_entry(src, proc))
+
+    async def build_task(self, task: Task) -> ChapterResult:
+        loop = asyncio.get_event_loop()
+        sources = await loop.run_in_executor(self.executor, task_sources, task)
+        renders = []
+        for src in dict.fromkeys(src for _, src in sources):
+            future = self.rendering.get(src)
+            if future is None:
+                future = self.rendering[src] = asyncio.ensure_future(self.render(src))
+                future.add_done_callback(
+                    lambda _, src=src: self.rendering.pop(src, None)
+                )
+            renders.append(future)
+        await asyncio.gather(*renders)
+        return await loop.run_in_executor(self.executor, build_task, task)
+
+    async def build(self, tasks: List[Task]) -> AsyncIterator[ChapterResult]:
+        """Results for `tasks`, in order."""
+        pending = collections.deque()
+        try:
+            for task in tasks:
+                if len(pending) >= self.in_flight:
+                    yield await pending.popleft()
+                pending.append(asyncio.ensure_future(self.build_task(task)))
+            while pending:
+                yield await pending.popleft()
+        finally:
+            for future in itertools.chain(pending, list(self.rendering.values())):
+                future.cancel()
+
+
+def build_chapters_async(tasks: List[Task], jobs: int, converters: int,
+                         in_flight: int) -> Iterator[ChapterResult]:
+    """Run an `AsyncPipeline` over `tasks`, yielding results in order."""
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    if jobs > 1:
+        executor = concurrent.futures.ProcessPoolExecutor(jobs)
+    else:
+        executor = concurrent.futures.ThreadPoolExecutor(1)
+    results = AsyncPipeline(executor, converters, in_flight).build(tasks)
+    try:
+        while True:
             try:
-                chapter_processed = process_chapter(chapter_txt)
-            except TeXRenderError as e:
-                cprint('Error while converting TeX to MathML', 'red', attrs=['bold'])
-                print(e.proc)
-                print(e.proc.output.strip())
-                cprint(e.proc.stderr.strip(), 'red')
-                cprint('TeX source:', 'red', attrs=['bold'])
-                print(e.src)
-                if e.context:
-                    cprint('Page context:', 'red', attrs=['bold'])
-                    print(e.context)
-                print('Check the chapter online:', colored(
-                    ONLINE_SRC_BASE + output_basename,
-                    'cyan', attrs=['underline']
-                ))
-                sys.exit(1)
-
-            f.write(str(process_chapter(read(chapter_filename))))
+                yield loop.run_until_complete(results.__anext__())
+            except StopAsyncIteration:
+                break
+    finally:
+        loop.run_until_complete(results.aclose())
+        executor.shutdown(wait=False)
+        loop.run_until_complete(loop.shutdown_asyncgens())
+        loop.close()
+        asyncio.set_event_loop(None)
 
+
+@dataclass
+class Target:
+    """One book's pages to bring up to date; see `build`."""
+    name: str
+    # Installs the book's settings, in whichever process builds its chapters
+    activate: Callable[[], None] = activate_nothing
+    # Where its output goes instead of `OUTPUT_DIR`, if anywhere
+    staging: Optional[StagingArchive] = None
+    manifest: dict = field(default_factory=dict)
+
+
+@dataclass
+class BuildResult:
+    # The targets and output names of the chapters built
+    built: List[Tuple[Target, str]] = field(default_factory=list)
+    # With `KEEP_GOING`, a `tex_error_record` for each formula left as an image
+    failures: List[dict] = field(default_factory=list)
+    report: profiling.Report = field(default_factory=profiling.Report)
+
+
+def stale_tasks(target: Target, force: bool) -> List[Task]:
+    """Load `target`'s manifest, and forget the chapters about to be rebuilt."""
+    target.activate()
+    chapters = source_chapters()
+    if target.staging is not None:
+        target.manifest = {} if force else target.staging.load_manifest()
+        stale = stale_chapters(chapters, target.manifest, target.staging.has)
+    else:
+        os.makedirs(OUTPUT_DIR, exist_ok=True)
+        target.manifest = {} if force else load_manifest()
+        stale = stale_chapters(chapters, target.manifest)
+    # Forget what we're about to overwrite, in case we don't finish
+    for chapter_filename in stale:
+        target.manifest.pop(path.basename(chapter_filename), None)
+
+    staging = target.staging
+    if staging is not None:
+        for fname in source_files(ASSET_EXTENSIONS):
+            staging.write(path.basename(fname), read_source(fname))
+        for output_basename in list(target.manifest):
+            if (staging.has(output_basename)
+                    and staging.has(metadata_filename(output_basename))):
+                staging.keep(output_basename)
+                staging.keep(metadata_filename(output_basename))
+            else:
+                del target.manifest[output_basename]
+
+    if stale:
+        cprint(f'{target.name}: {len(stale)} of {len(chapters)} chapters to build',
+               'green')
+    else:
+        cprint(f'{target.name}: all {len(chapters)} chapters up to date', 'green')
+    return [(target.activate, chapter_filename) for chapter_filename in stale]
+
+
+def build(targets: List[Target], args: argparse.Namespace,
+          stop_on_error: bool = True,
+          report_error: Callable[[TeXRenderError, str], None] = report_tex_error,
+          ) -> BuildResult:
+    """Build the stale chapters of every target, as `args` says to.
+
+    `args` has the options `add_build_arguments` adds, and `configure_build`
+    has been called with it. Chapters of every target share the workers,
+    converters and cache. A chapter that fails is passed to `report_error`,
+    and unless `stop_on_error`, left stale while the rest carry on.
+    """
+    result = BuildResult()
+    task_targets: List[Target] = []
+    tasks: List[Task] = []
+    for target in targets:
+        target_tasks = stale_tasks(target, args.force)
+        tasks.extend(target_tasks)
+        task_targets.extend(target for _ in target_tasks)
+
+    converters = args.converters or args.jobs
+    pool = None
+    results = None
+    complete = False
+    try:
+        if args.async_pipeline:
+            results = build_chapters_async(tasks, args.jobs, converters,
+                                           args.in_flight)
+        else:
+            if args.prerender and tasks:
+                with profiling.stage('prerender'):
+                    prerender(tasks, args.jobs, converters)
+            # Start workers after pre-rendering so they inherit a warm memo;
+            # a pool only pays for itself with more than one chapter
+            if args.jobs > 1 and len(tasks) > 1:
+                pool = multiprocessing.Pool(min(args.jobs, len(tasks)))
+                results = pool.imap(build_task, tasks)
+            else:
+                results = map(build_task, tasks)
+
+        for i, (target, (_, chapter_filename), chapter_result) in enumerate(
+                zip(task_targets, tasks, results)):
+            output_basename = path.basename(chapter_filename)
+            label = output_basename
+            if len(targets) > 1:
+                label = f'{target.name} {output_basename}'
+            print(colored(f'[{i + 1}/{len(tasks)}]:', 'green', attrs=['bold']),
+                  label)
+            if chapter_result.error is not None:
+                target.activate()
+                report_error(chapter_result.error, output_basename)
+                if stop_on_error:
+                    sys.exit(1)
+                # Left stale, so the next build tries it again
+                continue
+            for name, data in (chapter_result.files or {}).items():
+                target.staging.write(name, data)
+            # Left out of the manifest, so the next build tries them again;
+            # their failures are cached, so that's cheap
+            if chapter_result.failures:
+                cprint(f'{len(chapter_result.failures)} formulas left as images',
+                       'yellow')
+                result.failures.extend(dict(failure, book=target.name)
+                                       for failure in chapter_result.failures)
+            else:
+                target.manifest[output_basename] = chapter_result.manifest_entry
+            result.built.append((target, output_basename))
+            result.report.add(chapter_result.profile)
+        complete = True
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        if args.async_pipeline and results is not None:
+            results.close()
+        for target in targets:
+            target.activate()
+            if target.staging is not None:
+                target.staging.close(target.manifest, complete)
+            else:
+                save_manifest(target.manifest)
+    return result
+
+
+def add_build_arguments(parser: argparse.ArgumentParser):
+    """The options of every entry point that builds pages; see `build`."""
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of chapters to process in parallel')
+    parser.add_argument('--converters', type=int, default=None,
+                        help='number of formulas to render concurrently '
+                        '(default: same as --jobs)')
+    parser.add_argument('-f', '--force', action='store_true',
+                        help='rebuild chapters even if their inputs are unchanged')
+    parser.add_argument('-k', '--keep-going', action='store_true',
+                        help='leave formulas that fail to render as images, '
+                        'and list them all in --error-report, rather than '
+                        'stopping at the first')
+    parser.add_argument('--error-report', metavar='JSON', default='tex-errors.json',
+                        help='where --keep-going lists the formulas that '
+                        'failed (default: tex-errors.json)')
+    parser.add_argument('--retry-failed', action='store_true',
+                        help='try again to render formulas that failed before, '
+                        'rather than failing them from the cache')
+    parser.add_argument('--xhtml', action='store_true',
+                        help='write the pages as well-formed XHTML')
+    parser.add_argument('--no-prerender', dest='prerender',
+                        action='store_false',
+                        help="don't render every chapter's formulas up front")
+    parser.add_argument('--async', dest='async_pipeline', action='store_true',
+                        help='convert formulas as asyncio subprocesses, '
+                        'overlapped with building earlier chapters, instead '
+                        'of pre-rendering them all first')
+    parser.add_argument('--in-flight', type=int, default=4,
+                        help='with --async, how many chapters may be underway '
+                        'at once (default: 4)')
+    parser.add_argument('--memo-size', type=int, default=cache.MEMO_SIZE,
+                        help='number of formulas to keep in memory '
+                        f'(default: {cache.MEMO_SIZE})')
+    parser.add_argument('--preload-cache', action='store_true',
+                        help='read the whole formula cache into memory at startup')
+    parser.add_argument('--profile', metavar='REPORT',
+                        help='time each build stage and write a JSON report')
+    parser.add_argument('--profile-top', metavar='N', type=int, default=10,
+                        help='how many of the slowest chapters and formulas '
+                        'to summarize (default: 10)')
+    parser.add_argument('--fast-tex', action='store_true',
+                        help='render the simplest formulas in-process rather '
+                        'than with SnuggleTeX (see fasttex.py); check with '
+                        '--verify-fast-tex before relying on it')
+    parser.add_argument('--verify-fast-tex', action='store_true',
+                        help='also render those formulas with SnuggleTeX, and '
+                        'report each one that differs; implies --fast-tex')
+    parser.add_argument('--cache-backend', choices=sorted(cache.BACKENDS),
+                        default='sqlite',
+                        help='where to keep rendered formulas (default: sqlite)')
+    parser.add_argument('--cache-max-size', type=cache.parse_size,
+                        help='after building, evict the least recently used '
+                        'formulas until the cache is at most this big, like 20M')
+
+
+def configure_build(args: argparse.Namespace):
+    """Set up what `add_build_arguments`' options say, for the whole run."""
+    global KEEP_GOING, XHTML_OUTPUT
+    if args.profile:
+        profiling.enable()
+    if args.fast_tex or args.verify_fast_tex:
+        fasttex.enable(verify=args.verify_fast_tex)
+    KEEP_GOING = args.keep_going
+    XHTML_OUTPUT = args.xhtml
+    cache.init_cache(args.cache_backend, memo_size=args.memo_size,
+                     preload=args.preload_cache)
+    if args.retry_failed:
+        cache.delete_matching(is_failure)
+    converter.configure(args.converters or args.jobs)
+
+
+def finish_build(args: argparse.Namespace, result: BuildResult):
+    """Write the reports `args` asked for, and trim the cache."""
+    if args.profile:
+        result.report.write(args.profile)
+        result.report.print_summary(args.profile_top)
+    if args.keep_going:
+        write_error_report(args.error_report, result.failures)
+    if args.cache_max_size is not None:
+        evicted = cache.collect(args.cache_max_size).evicted
+        if evicted:
+            cprint(f'Evicted {evicted} formulas from the cache', 'green')
+    cache.flush()
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description='Convert LaTeX2HTML output into XHTML suitable for an EPUB.'
+    )
+    parser.add_argument('--source', metavar='PATH',
+                        help='the LaTeX2HTML output to convert: a directory, or a '
+                        f'tarball to read without extracting (default: {BOOK_SRC_DIR})')
+    parser.add_argument('--macros', metavar='PREAMBLE',
+                        help='a TeX file of \\newcommands for the macros the '
+                        'book uses (default: the ones in NEWCOMMANDS)')
+    parser.add_argument('--staging', metavar='ZIP',
+                        help=f'write the output to this zip instead of {OUTPUT_DIR}/, '
+                        'for epub.py --staging')
+    add_build_arguments(parser)
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None):
+    global BOOK_SRC_DIR, STAGE_OUTPUT, MACROS
+    args = parse_args(argv)
+    if args.source:
+        BOOK_SRC_DIR = args.source
+    if args.macros:
+        MACROS = load_macros(args.macros)
+    configure_build(args)
+
+    target = Target(path.basename(path.normpath(BOOK_SRC_DIR)))
+    if args.staging:
+        target.staging = StagingArchive(args.staging)
+        STAGE_OUTPUT = True
+    result = build([target], args)
+    finish_build(args, result)
+    if result.failures:
+        sys.exit(1)
     cprint('Done!', 'green', attrs=['bold'])
 
 
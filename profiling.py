@@ -0,0 +1,244 @@
+"""Opt-in timing of where a build spends its time.
+
+Nothing is recorded until `enable` is called. Time is attributed to the
+chapter being built (see `begin_chapter`), or to the build as a whole
+outside of one. Stages may nest, and their times include any nested stages.
+"""
+
+import contextlib
+import json
+import threading
+import time
+from typing import Dict, List, Optional
+
+from termcolor import colored, cprint
+
+_enabled = False
+_lock = threading.Lock()
+
+
+def enable():
+    global _enabled
+    _enabled = True
+
+
+def enabled() -> bool:
+    return _enabled
+
+
+class Profile:
+    """Stage and formula timings for one chapter, or for a whole build."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.seconds = 0.0
+        self.stages: Dict[str, float] = {}
+        # tex -> [uses, cache misses, total seconds, converter seconds]
+        self.formulas: Dict[str, list] = {}
+        # Events worth counting but not timing, like memo hits
+        self.counts: Dict[str, int] = {}
+
+    def add_stage(self, stage: str, seconds: float):
+        with _lock:
+            self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def add_count(self, name: str, n: int):
+        with _lock:
+            self.counts[name] = self.counts.get(name, 0) + n
+
+    def add_formula(self, tex: str, seconds: float, convert_seconds: Optional[float]):
+        with _lock:
+            stats = self.formulas.setdefault(tex, [0, 0, 0.0, 0.0])
+            stats[0] += 1
+            stats[2] += seconds
+            if convert_seconds is not None:
+                stats[1] += 1
+                stats[3] += convert_seconds
+
+    def merge(self, other: 'Profile'):
+        for stage, seconds in other.stages.items():
+            self.add_stage(stage, seconds)
+        for name, n in other.counts.items():
+            self.add_count(name, n)
+        with _lock:
+            for tex, theirs in other.formulas.items():
+                ours = self.formulas.setdefault(tex, [0, 0, 0.0, 0.0])
+                for i, value in enumerate(theirs):
+                    ours[i] += value
+
+    def formula_totals(self) -> dict:
+        uses = misses = 0
+        seconds = convert_seconds = 0.0
+        for stats in self.formulas.values():
+            uses += stats[0]
+            misses += stats[1]
+            seconds += stats[2]
+            convert_seconds += stats[3]
+        return {
+            'uses': uses,
+            'hits': uses - misses,
+            'misses': misses,
+            'seconds': seconds,
+            'convert_seconds': convert_seconds,
+        }
+
+
+_build = Profile('build')
+_local = threading.local()
+
+
+def _current() -> Profile:
+    return getattr(_local, 'profile', None) or _build
+
+
+def begin_chapter(name: str):
+    if _enabled:
+        _local.profile = Profile(name)
+        _local.start = time.perf_counter()
+
+
+def end_chapter() -> Optional[Profile]:
+    if not _enabled:
+        return None
+    profile = _local.profile
+    profile.seconds = time.perf_counter() - _local.start
+    _local.profile = None
+    return profile
+
+
+@contextlib.contextmanager
+def stage(name: str):
+    if not _enabled:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _current().add_stage(name, time.perf_counter() - start)
+
+
+def count(name: str, n: int = 1):
+    if _enabled:
+        _current().add_count(name, n)
+
+
+class FormulaTimer:
+    """Times one formula lookup, and the conversion if it missed the cache."""
+
+    def __init__(self, tex: str):
+        self.tex = tex
+        self.convert_seconds = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        _current().add_formula(
+            self.tex, time.perf_counter() - self.start, self.convert_seconds
+        )
+
+    @contextlib.contextmanager
+    def converting(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.convert_seconds = time.perf_counter() - start
+
+
+def formula(tex: str):
+    if not _enabled:
+        return contextlib.nullcontext(_NULL_TIMER)
+    return FormulaTimer(tex)
+
+
+class _NullTimer:
+    @contextlib.contextmanager
+    def converting(self):
+        yield
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class Report:
+    """Collects chapter profiles and summarizes them."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.chapters: List[Profile] = []
+
+    def add(self, profile: Optional[Profile]):
+        if profile is not None:
+            self.chapters.append(profile)
+
+    def totals(self) -> Profile:
+        total = Profile('total')
+        total.merge(_build)
+        for chapter in self.chapters:
+            total.merge(chapter)
+        return total
+
+    def to_json(self) -> dict:
+        total = self.totals()
+        return {
+            'seconds': time.perf_counter() - self.start,
+            'stages': total.stages,
+            'formula_totals': total.formula_totals(),
+            'counts': total.counts,
+            'chapters': [
+                {
+                    'name': chapter.name,
+                    'seconds': chapter.seconds,
+                    'stages': chapter.stages,
+                    'formulas': chapter.formula_totals(),
+                    'counts': chapter.counts,
+                }
+                for chapter in self.chapters
+            ],
+            'formulas': [
+                {
+                    'tex': tex,
+                    'uses': uses,
+                    'misses': misses,
+                    'seconds': seconds,
+                    'convert_seconds': convert_seconds,
+                }
+                for tex, (uses, misses, seconds, convert_seconds)
+                in sorted(total.formulas.items(), key=lambda kv: -kv[1][2])
+            ],
+        }
+
+    def write(self, fname: str):
+        with open(fname, 'w', encoding='utf-8') as f:
+            json.dump(self.to_json(), f, indent=2)
+
+    def print_summary(self, top: int = 10):
+        report = self.to_json()
+        cprint('Time by stage:', 'cyan', attrs=['bold'])
+        for name, seconds in sorted(report['stages'].items(), key=lambda kv: -kv[1]):
+            print(f'  {seconds:9.3f}s  {name}')
+
+        totals = report['formula_totals']
+        print(colored('Formulas:', 'cyan', attrs=['bold']),
+              f"{totals['hits']} hits, {totals['misses']} misses,",
+              f"{totals['convert_seconds']:.3f}s in the converter")
+        counts = report['counts']
+        print(colored('Formula memo:', 'cyan', attrs=['bold']),
+              f"{counts.get('memo hits', 0)} hits,",
+              f"{counts.get('memo misses', 0)} misses,",
+              f"{counts.get('memo evictions', 0)} evictions")
+
+        cprint(f'Slowest {top} chapters:', 'cyan', attrs=['bold'])
+        slowest = sorted(report['chapters'], key=lambda c: -c['seconds'])
+        for chapter in slowest[:top]:
+            print(f"  {chapter['seconds']:9.3f}s  {chapter['name']}")
+
+        cprint(f'Slowest {top} formulas:', 'cyan', attrs=['bold'])
+        for stats in report['formulas'][:top]:
+            tex = stats['tex'].replace('\n', ' ')
+            if len(tex) > 60:
+                tex = tex[:57] + '...'
+            print(f"  {stats['seconds']:9.3f}s  x{stats['uses']:<5} {tex}")
@@ -31,7 +31,12 @@ stdenv.mkDerivation rec {
   ];
 
   dontConfigure = true;
-  dontBuild = true;
+  buildPhase =
+    ''
+      mkdir -p server
+      javac -cp ./source/bin/snuggletex-core-${version}.jar \
+        -d server ./snuggletex/SnuggleServer.java
+    '';
   installPhase =
     ''
       mkdir -p $out
@@ -45,6 +50,12 @@ stdenv.mkDerivation rec {
       cp ./snuggletex/snuggletex.sh $out/bin/snuggletex
       chmod +x $out/bin/snuggletex
       substituteAllInPlace $out/bin/snuggletex
+
+      mkdir -p $out/share
+      mv server $out/share/snuggletex-server
+      cp ./snuggletex/snuggletex-server.sh $out/bin/snuggletex-server
+      chmod +x $out/bin/snuggletex-server
+      substituteAllInPlace $out/bin/snuggletex-server
     '';
 
   meta = with lib; {
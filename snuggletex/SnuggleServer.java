@@ -0,0 +1,150 @@
+import java.io.BufferedInputStream;
+import java.io.BufferedOutputStream;
+import java.io.ByteArrayInputStream;
+import java.io.ByteArrayOutputStream;
+import java.io.DataInputStream;
+import java.io.EOFException;
+import java.io.FileDescriptor;
+import java.io.FileOutputStream;
+import java.io.IOException;
+import java.io.InputStream;
+import java.io.OutputStream;
+import java.io.PrintStream;
+import java.lang.reflect.InvocationTargetException;
+import java.lang.reflect.Method;
+import java.nio.charset.StandardCharsets;
+import java.security.Permission;
+import java.util.jar.Attributes;
+import java.util.jar.JarFile;
+
+/**
+ * Resident wrapper around the SnuggleTeX command-line converter.
+ *
+ * Runs the jar's own main class once per request, in-process, so the output
+ * is exactly what `snuggletex -` would print, without paying for a JVM
+ * startup per formula.
+ *
+ * Requests on stdin are framed as "<length>\n<TeX bytes>"; each response on
+ * stdout is "<status> <stdout length> <stderr length>\n<stdout><stderr>".
+ * All lengths are in bytes of UTF-8.
+ */
+public final class SnuggleServer {
+    private static final class ExitTrappedException extends SecurityException {
+        final int status;
+
+        ExitTrappedException(int status) {
+            super("System.exit(" + status + ")");
+            this.status = status;
+        }
+    }
+
+    private static final class ExitTrap extends SecurityManager {
+        @Override
+        public void checkExit(int status) {
+            throw new ExitTrappedException(status);
+        }
+
+        @Override
+        public void checkPermission(Permission perm) {
+        }
+
+        @Override
+        public void checkPermission(Permission perm, Object context) {
+        }
+    }
+
+    public static void main(String[] args) throws Exception {
+        if (args.length != 1) {
+            System.err.println("usage: SnuggleServer SNUGGLETEX_JAR");
+            System.exit(2);
+        }
+
+        String mainClassName;
+        try (JarFile jar = new JarFile(args[0])) {
+            mainClassName = jar.getManifest().getMainAttributes()
+                .getValue(Attributes.Name.MAIN_CLASS);
+        }
+        Method cliMain = Class.forName(mainClassName).getMethod("main", String[].class);
+
+        try {
+            System.setSecurityManager(new ExitTrap());
+        } catch (UnsupportedOperationException | SecurityException e) {
+            // Newer JVMs refuse this; the client restarts us if the CLI exits.
+        }
+
+        DataInputStream in = new DataInputStream(new BufferedInputStream(System.in));
+        OutputStream out = new BufferedOutputStream(new FileOutputStream(FileDescriptor.out));
+
+        while (true) {
+            String header = readLine(in);
+            if (header == null) {
+                break;
+            }
+            byte[] tex = new byte[Integer.parseInt(header.trim())];
+            in.readFully(tex);
+
+            ByteArrayOutputStream stdout = new ByteArrayOutputStream();
+            ByteArrayOutputStream stderr = new ByteArrayOutputStream();
+            int status = run(cliMain, tex, stdout, stderr);
+
+            byte[] outBytes = stdout.toByteArray();
+            byte[] errBytes = stderr.toByteArray();
+            out.write((status + " " + outBytes.length + " " + errBytes.length + "\n")
+                .getBytes(StandardCharsets.US_ASCII));
+            out.write(outBytes);
+            out.write(errBytes);
+            out.flush();
+        }
+    }
+
+    private static int run(Method cliMain, byte[] tex,
+                           ByteArrayOutputStream stdout, ByteArrayOutputStream stderr)
+            throws IOException {
+        InputStream oldIn = System.in;
+        PrintStream oldOut = System.out;
+        PrintStream oldErr = System.err;
+        PrintStream reqOut = new PrintStream(stdout, true, "UTF-8");
+        PrintStream reqErr = new PrintStream(stderr, true, "UTF-8");
+        System.setIn(new ByteArrayInputStream(tex));
+        System.setOut(reqOut);
+        System.setErr(reqErr);
+        int status = 0;
+        try {
+            cliMain.invoke(null, (Object) new String[] {"-"});
+        } catch (InvocationTargetException e) {
+            Throwable cause = e.getCause();
+            if (cause instanceof ExitTrappedException) {
+                status = ((ExitTrappedException) cause).status;
+            } else {
+                cause.printStackTrace(reqErr);
+                status = 1;
+            }
+        } catch (IllegalAccessException e) {
+            e.printStackTrace(reqErr);
+            status = 1;
+        } finally {
+            reqOut.flush();
+            reqErr.flush();
+            System.setIn(oldIn);
+            System.setOut(oldOut);
+            System.setErr(oldErr);
+        }
+        return status;
+    }
+
+    private static String readLine(DataInputStream in) throws IOException {
+        StringBuilder line = new StringBuilder();
+        while (true) {
+            int c;
+            try {
+                c = in.readUnsignedByte();
+            } catch (EOFException e) {
+                return line.length() == 0 ? null : line.toString();
+            }
+            if (c == '\n') {
+                return line.toString();
+            }
+            line.append((char) c);
+        }
+    }
+}
@@ -0,0 +1,4 @@
+#!/bin/bash
+@java@/bin/java -Dfile.encoding=UTF-8 \
+  -cp @out@/bin/snuggletex-core-1.2.2.jar:@out@/share/snuggletex-server \
+  SnuggleServer @out@/bin/snuggletex-core-1.2.2.jar "$@"
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3.7
+
+"""Rebuild a book, and its EPUB, whenever its inputs change.
+
+    ./watch.py books/information-retrieval.json
+
+Builds whatever is stale, then polls the book's inputs: its source pages
+and images, its stylesheet and its macros file. When any of them change,
+only the chapters whose source or formulas changed are processed again,
+and the EPUB is rewritten. The formula cache, the resident converters and
+the assembled book stay loaded between rebuilds, so an edit to one page
+takes a second or two rather than a full build.
+
+Edits to the pipeline's own code, or to the book's manifest, restart the
+watcher, since they can change anything.
+"""
+
+import argparse
+import os
+from os import path
+import sys
+import time
+from typing import Dict, List, Optional, Set, Tuple
+
+from ebooklib.epub import EpubBook
+from termcolor import cprint
+
+from book import Book
+import build
+import cache
+import converter
+import epub
+import fasttex
+import process_book_html
+import profiling
+import xhtml
+
+# Editing any of these restarts the watcher
+CODE_FILES = [
+    module.__file__
+    for module in (build, cache, converter, epub, fasttex, process_book_html,
+                   profiling, xhtml, sys.modules[Book.__module__])
+] + [__file__]
+
+Snapshot = Dict[str, Tuple[int, int]]
+
+
+def snapshot(fnames: List[str]) -> Snapshot:
+    """The size and mtime of every file in `fnames` that exists."""
+    stats = {}
+    for fname in fnames:
+        try:
+            st = os.stat(fname)
+        except FileNotFoundError:
+            continue
+        stats[fname] = (st.st_mtime_ns, st.st_size)
+    return stats
+
+
+def source_inputs() -> List[str]:
+    """The files the book's pages and images are read from."""
+    if process_book_html.source_archive() is not None:
+        return [process_book_html.BOOK_SRC_DIR]
+    return process_book_html.source_files(
+        ('.html',) + process_book_html.ASSET_EXTENSIONS
+    )
+
+
+def page_summary(output_name: str) -> dict:
+    """The parts of a page's metadata that `epub.make_epub` uses."""
+    metadata = process_book_html.load_metadata(
+        path.join(process_book_html.OUTPUT_DIR, output_name)
+    )
+    return {key: metadata[key] for key in ('title', 'mathml', 'toc')}
+
+
+class Watcher:
+    def __init__(self, book: Book, args: argparse.Namespace):
+        self.book = book
+        self.args = args
+        self.epub_book: Optional[EpubBook] = None
+        # What `epub_book` was assembled from
+        self.pages: Dict[str, dict] = {}
+        self.output_names: List[str] = []
+        # Errors already shown in full, by page and TeX
+        self.reported: Set[Tuple[str, str]] = set()
+
+    def inputs(self) -> Snapshot:
+        fnames = source_inputs() + [epub.css_filename]
+        if self.book.macros is not None:
+            fnames.append(self.book.macros)
+        return snapshot(fnames)
+
+    def report_error(self, e: process_book_html.TeXRenderError, output_basename: str):
+        if (output_basename, e.src) in self.reported:
+            cprint(f"{output_basename} still has a formula that won't render", 'red')
+        else:
+            process_book_html.report_tex_error(e, output_basename)
+            self.reported.add((output_basename, e.src))
+
+    def build_chapters(self) -> List[str]:
+        """Build the stale chapters, returning the names of their pages."""
+        result = process_book_html.build(
+            [process_book_html.Target(self.book.name, self.book.activate)],
+            self.args, stop_on_error=False, report_error=self.report_error,
+        )
+        process_book_html.finish_build(self.args, result)
+        # Only the first build is forced; after that, only changes count
+        self.args.force = False
+        return [output_basename for _, output_basename in result.built]
+
+    def assemble(self, built: List[str], restyled: bool):
+        """Rewrite the EPUB, reassembling the book only if its outline changed.
+
+        The book's pages and images are read from the output directory as
+        it's written, so new content needs no reassembly; new titles, tables
+        of contents, files or a new stylesheet do.
+        """
+        build.copy_assets(self.book)
+        output_names = sorted(os.listdir(process_book_html.OUTPUT_DIR))
+        if (self.epub_book is None or restyled or output_names != self.output_names
+                or any(self.pages.get(name) != page_summary(name) for name in built)):
+            self.epub_book = epub.make_epub(streaming=True)
+            if epub.check_book(self.epub_book):
+                self.epub_book = None
+                return
+            self.pages = {
+                name: page_summary(name)
+                for name in output_names if name.endswith('.html')
+            }
+            self.output_names = output_names
+
+        tmp = epub.output_filename + '.tmp'
+        epub.write_book(self.epub_book, tmp)
+        os.replace(tmp, epub.output_filename)
+        cprint(f'Wrote {epub.output_filename}', 'green')
+
+    def rebuild(self, changed: List[str]):
+        start = time.perf_counter()
+        if self.book.macros in changed:
+            process_book_html.load_macros.cache_clear()
+        if process_book_html.BOOK_SRC_DIR in changed:
+            process_book_html.load_archive.cache_clear()
+        self.book.activate()
+
+        built = self.build_chapters()
+        restyled = epub.css_filename in changed
+        if self.args.epub and (built or changed or self.epub_book is None):
+            self.assemble(built, restyled)
+        cprint(f'Up to date in {time.perf_counter() - start:.1f}s; watching',
+               'green', attrs=['bold'])
+
+
+def restart():
+    cprint('Pipeline code changed; restarting', 'yellow', attrs=['bold'])
+    cache.flush()
+    converter.close()
+    os.execv(sys.executable, [sys.executable] + sys.argv)
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument('book', metavar='BOOK',
+                        help='JSON manifest describing the book')
+    parser.add_argument('--interval', type=float, default=0.5,
+                        help='seconds between checks for changes (default: 0.5)')
+    parser.add_argument('--no-epub', dest='epub', action='store_false',
+                        help="process the pages, but don't assemble the EPUB")
+    process_book_html.add_build_arguments(parser)
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None):
+    args = parse_args(argv)
+    book = Book.load(args.book)
+    book.activate()
+    process_book_html.configure_build(args)
+
+    code_files = CODE_FILES + [args.book]
+    code = snapshot(code_files)
+    watcher = Watcher(book, args)
+    inputs = watcher.inputs()
+    watcher.rebuild([])
+    try:
+        while True:
+            time.sleep(args.interval)
+            if snapshot(code_files) != code:
+                restart()
+            current = watcher.inputs()
+            if current == inputs:
+                continue
+            changed = sorted(
+                fname for fname in current.keys() | inputs.keys()
+                if current.get(fname) != inputs.get(fname)
+            )
+            inputs = current
+            watcher.rebuild(changed)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+"""Writes BeautifulSoup trees out, faster than `str(soup)`.
+
+`write` streams a page to a file in pieces rather than building it up as
+one string, and skips most of the per-node work BeautifulSoup's serializer
+does to support formatters and pretty-printing we don't use. By default its
+output is exactly what `str(soup)` would have been.
+
+With `xhtml`, the output is well-formed XML as well, so it can be served
+as XHTML without another conversion pass:
+
+- `<html>` gets the XHTML namespace
+- attributes are always double-quoted, and those without a value get an
+  empty one; attributes whose names aren't valid in XML are dropped
+- text is escaped inside `<script>` and `<style>` too
+- `--` in comments, and characters XML doesn't allow at all, are removed
+"""
+
+import re
+from typing import List, TextIO
+
+from bs4 import BeautifulSoup, Tag
+from bs4.element import AttributeValueWithCharsetSubstitution, PreformattedString
+
+XHTML_NAMESPACE = 'http://www.w3.org/1999/xhtml'
+# BeautifulSoup leaves these unescaped in HTML
+CDATA_CONTAINING_TAGS = {'script', 'style'}
+# What `str(soup)` passes for `<meta charset>` and the like
+ENCODING = 'utf-8'
+# Pieces to collect before each write to the file
+BUFFER_PIECES = 4096
+
+XML_NAME = re.compile(r'(?:xml:|xmlns:)?[A-Za-z_][A-Za-z0-9_.-]*$')
+XML_INVALID_CHARS = re.compile(r'[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]')
+
+
+class RawMarkup(PreformattedString):
+    """Markup that's already been serialized, to be written out as it is.
+
+    Lets a subtree be spliced into a page as a single string rather than
+    parsed into tags, for both `write` and `str(soup)`. It must already be
+    in the form `write` would have produced, XHTML or not.
+    """
+    PREFIX = ''
+    SUFFIX = ''
+
+
+def escape(s: str) -> str:
+    if '&' in s:
+        s = s.replace('&', '&amp;')
+    if '<' in s:
+        s = s.replace('<', '&lt;')
+    if '>' in s:
+        s = s.replace('>', '&gt;')
+    return s
+
+
+def quote_attribute(value: str) -> str:
+    """BeautifulSoup's quoting, which avoids `&quot;` where it can."""
+    if '"' in value:
+        if "'" in value:
+            return '"' + value.replace('"', '&quot;') + '"'
+        return "'" + value + "'"
+    return '"' + value + '"'
+
+
+def end_tag(tag: Tag) -> str:
+    return f'</{tag.prefix}:{tag.name}>' if tag.prefix else f'</{tag.name}>'
+
+
+def attribute_text(value) -> str:
+    if isinstance(value, (list, tuple)):
+        return ' '.join(value)
+    if isinstance(value, AttributeValueWithCharsetSubstitution):
+        return value.substitute_encoding(ENCODING)
+    return str(value)
+
+
+class _Writer:
+    def __init__(self, f: TextIO, xhtml: bool):
+        self.f = f
+        self.xhtml = xhtml
+        self.pieces: List[str] = []
+
+    def flush(self):
+        self.f.write(''.join(self.pieces))
+        self.pieces.clear()
+
+    def start_tag(self, tag: Tag) -> str:
+        name = tag.prefix + ':' + tag.name if tag.prefix else tag.name
+        attrs = sorted(tag.attrs.items())
+        if self.xhtml and name == 'html' and 'xmlns' not in tag.attrs:
+            attrs.insert(0, ('xmlns', XHTML_NAMESPACE))
+
+        pieces = ['<', name]
+        for key, value in attrs:
+            if value is None:
+                if self.xhtml:
+                    pieces.append(f' {key}=""')
+                else:
+                    pieces.append(' ' + key)
+                continue
+            value = escape(attribute_text(value))
+            if not self.xhtml:
+                pieces.append(f' {key}={quote_attribute(value)}')
+            elif XML_NAME.match(key):
+                value = XML_INVALID_CHARS.sub('', value.replace('"', '&quot;'))
+                pieces.append(f' {key}="{value}"')
+        if not tag.contents and tag.can_be_empty_element:
+            pieces.append('/>')
+        else:
+            pieces.append('>')
+        return ''.join(pieces)
+
+    def string(self, s: str, parent: Tag) -> str:
+        if isinstance(s, RawMarkup):
+            return str(s)
+        if isinstance(s, PreformattedString):
+            text = str(s)
+            if self.xhtml:
+                text = XML_INVALID_CHARS.sub('', text)
+                if s.PREFIX == '<!--':
+                    text = text.replace('--', '')
+                    if text.endswith('-'):
+                        text += ' '
+            return s.PREFIX + text + s.SUFFIX
+        if self.xhtml:
+            return XML_INVALID_CHARS.sub('', escape(s))
+        if parent is not None and parent.name in CDATA_CONTAINING_TAGS:
+            return str(s)
+        return escape(s)
+
+    def write(self, root: Tag):
+        pieces = self.pieces
+        # The children still to write at each level, and how to close it
+        stack = [iter(root.contents)]
+        end_tags = ['']
+        while stack:
+            for el in stack[-1]:
+                if isinstance(el, Tag):
+                    if el.hidden:
+                        stack.append(iter(el.contents))
+                        end_tags.append('')
+                        break
+                    pieces.append(self.start_tag(el))
+                    if el.contents:
+                        stack.append(iter(el.contents))
+                        end_tags.append(end_tag(el))
+                        break
+                    if not el.can_be_empty_element:
+                        pieces.append(end_tag(el))
+                else:
+                    pieces.append(self.string(el, el.parent))
+                if len(pieces) >= BUFFER_PIECES:
+                    self.flush()
+            else:
+                stack.pop()
+                pieces.append(end_tags.pop())
+        self.flush()
+
+
+def write(soup: BeautifulSoup, f: TextIO, xhtml: bool = False):
+    """Write `soup` to `f`; see the module docstring."""
+    _Writer(f, xhtml).write(soup)